@@ -1,6 +1,6 @@
 """This module provides the ability to a moderator to sync the commands
 
-To register changes to commands, the bot must be resynced 
+To register changes to commands, the bot must be resynced
 """
 
 from discord.ext import commands
@@ -44,6 +44,28 @@ class Admin(commands.Cog, name="admin"):
 
         await ctx.send(msg)
 
+    @commands.command(
+        name="writes",
+        description="Shows the state of the Discord write scheduler.",
+    )
+    @commands.has_permissions(administrator=True)
+    async def write_stats(self, ctx: Context) -> None:
+        """
+        Shows the queued writes per priority, the counters and the queueing latency
+
+        :param context: The command context.
+        """
+        stats = ctx.bot.writes.stats()
+        await ctx.send(
+            f"Queued writes: {stats['queued']} ({stats['user']} user, "
+            f"{stats['normal']} normal, {stats['background']} background)\n```\n"
+            f"- running: {stats['running']}\n"
+            f"- done: {stats['done']}, failed: {stats['failed']}, "
+            f"coalesced: {stats['coalesced']}\n"
+            f"- latency: {stats['latency']:.2f}s average, "
+            f"{stats['max_latency']:.2f}s max\n```"
+        )
+
 
 async def setup(bot) -> None:  # pylint: disable=missing-function-docstring
     await bot.add_cog(Admin(bot))
@@ -2,41 +2,40 @@
 
 Some of the web challs are based on client-side attacks such as xss, csrf, etc.
 this cog provides the bot with the ability to visit sent websites with the
-payloads provided as links.
+payloads provided as links. The visits themselves are done by browser workers
+(see `bot/worker.py`), this cog only queues them and relays their status.
 """
 
-import base64
+import asyncio
 import logging
-import time
 import re
-from collections.abc import Callable
 
 import discord
 from discord import app_commands
 from discord.ext import commands
-from selenium.webdriver.firefox.options import Options
-from selenium import webdriver
+from discord.ext.commands import Context
+from .common.challenges import CHALLENGES  # type: ignore  # pylint: disable=import-error
+from .common.jobs import DONE, FAILED, QUEUED, JobQueue  # type: ignore  # pylint: disable=import-error
 
-try:
-    from .ctf import corn, exss, mlb  # type: ignore
-except ImportError:
-    logging.warning("CTF module not found, using default values")
-    corn = {"password": "flag"}
-    exss = mlb = {"flag": "flag"}
+STATUS_POLL = 1  # seconds between status checks of a queued visit
+STATUS_TIMEOUT = 10 * 60  # seconds after which we stop waiting for a visit
+WORKER_TIMEOUT = 60  # seconds without a report after which a worker isn't listed
 
 
 class Browser(commands.Cog, name="browser"):
-    """The class that simulates the browser and visits the link of a specified challenge"""
+    """The class that queues visits to the link of a specified challenge"""
 
     def __init__(self, bot) -> None:
-        self.browser = None
-
         self.bot = bot
-        self.challenges: dict[str, Callable[[webdriver.Firefox], None]] = {
-            "corn": self.corn,
-            "exss": self.exss,
-            "mlb": self.my_little_browser,
-        }
+        self.queue = JobQueue(f"{self.bot.shared}/visits.db")
+        self.following: set[asyncio.Task] = set()
+        self.submitted = 0
+        self.coalesced = 0
+
+    async def cog_unload(self) -> None:
+        """Stops following the status of queued visits"""
+        for task in self.following:
+            task.cancel()
 
     @app_commands.checks.cooldown(1.0, 60.0, key=lambda i: (i.user.id))
     @app_commands.command(name="visit", description="Visits a link for a challenge")
@@ -80,7 +79,7 @@ class Browser(commands.Cog, name="browser"):
                 "This command can only be used in DMs!", ephemeral=True
             )
 
-        if challenge_choice not in self.challenges:
+        if challenge_choice not in CHALLENGES:
             return await interaction.response.send_message(
                 "Invalid challenge chosen!", ephemeral=True
             )
@@ -90,69 +89,89 @@ class Browser(commands.Cog, name="browser"):
                 "Invalid URL, try again", ephemeral=True
             )
 
-        await interaction.response.send_message("Visiting link...")
-        message = await interaction.original_response()
-        browser = self.setup_challenge(challenge_choice)
-
-        try:
-            browser.get(url)
-        except Exception:  # pylint: disable=broad-exception-caught
-            await message.edit(content="Unable to visit link!")
+        if (
+            await asyncio.to_thread(self.queue.queued)
+            >= self.bot.config["browser"]["queue_size"]
+        ):
+            await interaction.response.send_message(
+                "Too many links are waiting to be visited, try again later",
+                ephemeral=True,
+            )
             return
 
-        time.sleep(10)  # Give the JS a second to execute
-        await message.edit(content="Visited link!")
-        browser.quit()
+        await interaction.response.send_message("Queueing link...")
+        message = await interaction.original_response()
+        job_id, coalesced = await asyncio.to_thread(
+            self.queue.enqueue,
+            challenge_choice,
+            url,
+            self.bot.config["browser"]["dedup_window"],
+        )
+
+        self.submitted += 1
+        if coalesced:
+            self.coalesced += 1
+            logging.info(
+                "Coalesced visit for %s with visit %d, %d/%d (%.0f%%) visits coalesced",
+                challenge_choice,
+                job_id,
+                self.coalesced,
+                self.submitted,
+                100 * self.coalesced / self.submitted,
+            )
 
-    def setup_challenge(self, challenge: str) -> webdriver.Firefox:
+        task = asyncio.create_task(self.follow(job_id, message))
+        self.following.add(task)
+        task.add_done_callback(self.following.discard)
+
+    async def follow(self, job_id: int, message: discord.Message) -> None:
+        """Relays the status of a queued visit to the user until it is finished"""
+        shown = None
+        for _ in range(STATUS_TIMEOUT // STATUS_POLL):
+            status, position = await asyncio.to_thread(self.queue.status, job_id)
+            if status == DONE:
+                content = "Visited link!"
+            elif status == FAILED:
+                content = "Unable to visit link!"
+            elif status == QUEUED:
+                content = f"Waiting to visit link, position {position}..."
+            else:
+                content = "Visiting link..."
+
+            if content != shown:
+                shown = content
+                try:
+                    await message.edit(content=content)
+                except discord.errors.HTTPException:
+                    return
+
+            if status in (DONE, FAILED):
+                return
+            await asyncio.sleep(STATUS_POLL)
+
+        await message.edit(content="Unable to visit link, no browser is available!")
+
+    @commands.command(
+        name="pool",
+        description="Shows the state of the browser pool.",
+    )
+    @commands.has_permissions(administrator=True)
+    async def pool_stats(self, ctx: Context) -> None:
         """
-        This function does browser setup thats common, and then calls the
-        specific challenge setup function
+        Shows the queue length and the browser pool of every running worker
 
-        Args:
-            challenge: a string of the challenge name
+        :param context: The command context.
         """
-        opts = Options()
-        opts.set_headless()
-
-        profile = webdriver.FirefoxProfile()
-        profile.DEFAULT_PREFERENCES["frozen"][  # type: ignore # pylint: disable=unsubscriptable-object
-            "network.cookie.cookieBehavior"
-        ] = 4
-        browser = webdriver.Firefox(options=opts, firefox_profile=profile)
-        browser.set_page_load_timeout(10)
-        browser.delete_all_cookies()
-
-        self.challenges[challenge](browser)
-
-        browser.get("about:newtab")
-        return browser
-
-    @staticmethod
-    def corn(browser: webdriver.Firefox) -> None:
-        """This function sets up for the **corn** challenge"""
-        browser.get("http://challs.studsec.nl:5100/login")
-        username = browser.find_element_by_id("username")
-        password = browser.find_element_by_id("password")
-        username.send_keys("admin")
-        password.send_keys(corn["password"])
-        browser.find_element_by_name("login").click()
-
-    @staticmethod
-    def exss(browser: webdriver.Firefox) -> None:
-        """This function sets up for the **exss** challenge"""
-        browser.get(
-            "http://challs.studsec.nl:5080/?"
-            + base64.b64encode(exss["flag"].encode()).decode("ascii")
-        )
+        workers = await asyncio.to_thread(self.queue.workers, WORKER_TIMEOUT)
+        msg = f"Queued visits: {await asyncio.to_thread(self.queue.queued)}\n```\n"
+        for name, stats in workers.items():
+            msg += (
+                f"- {name}: {stats['idle']} idle, {stats['hits']} hits, "
+                f"{stats['misses']} misses, {stats['recycled']} recycled\n"
+            )
+        msg += "```" if workers else "No workers running```"
 
-    @staticmethod
-    def my_little_browser(browser: webdriver.Firefox) -> None:
-        """This function sets up for the **my little browser** challenge"""
-        browser.get(
-            "http://challs.studsec.nl:5480/?page="
-            + base64.b64encode(mlb["flag"].encode()).decode("ascii")
-        )
+        await ctx.send(msg)
 
 
 async def setup(bot) -> None:  # pylint: disable=missing-function-docstring
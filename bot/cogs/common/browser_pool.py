@@ -0,0 +1,231 @@
+"""This module implements a pool of warm, headless Firefox instances for the browser cog.
+
+Launching Firefox and geckodriver takes seconds, so instead of starting a browser
+per visit, a few instances per challenge are launched and set up ahead of time.
+After a visit the data of every site is cleared and the instance is set up again, or
+it is recycled when it has served too many visits, grown too large or can't be reset.
+"""
+
+from __future__ import annotations
+import logging
+import os
+import threading
+from collections.abc import Callable
+
+from selenium import webdriver  # type: ignore
+from selenium.common.exceptions import WebDriverException  # type: ignore
+from selenium.webdriver.firefox.options import Options  # type: ignore
+
+# Clears the cookies, storage, caches and service workers of all sites, run as chrome
+CLEAR_SITE_DATA = (
+    "const done = arguments[arguments.length - 1];"
+    "Services.clearData.deleteData(Ci.nsIClearDataService.CLEAR_ALL, () => done());"
+)
+
+
+def _process_tree_rss(pid: int) -> int:
+    """Returns the resident set size in bytes of a process and all its descendants
+
+    Reads `/proc` directly, on systems without it this always returns 0.
+    """
+    children: dict[int, list[int]] = {}
+    rss: dict[int, int] = {}
+
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return 0
+
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/status", "r", encoding="utf-8") as file:
+                status = dict(
+                    line.split(":", 1)
+                    for line in file.read().splitlines()
+                    if ":" in line
+                )
+        except OSError:
+            continue  # process exited while we were looking
+
+        children.setdefault(int(status["PPid"].strip()), []).append(int(entry))
+        if "VmRSS" in status:
+            rss[int(entry)] = int(status["VmRSS"].split()[0]) * 1024
+
+    total, todo = 0, [pid]
+    while todo:
+        current = todo.pop()
+        total += rss.get(current, 0)
+        todo += children.get(current, [])
+    return total
+
+
+class PooledBrowser:
+    """A warm Firefox instance that has been set up for a single challenge"""
+
+    def __init__(self, challenge: str, driver: webdriver.Firefox) -> None:
+        self.challenge = challenge
+        self.driver = driver
+        self.visits = 0
+
+    def rss(self) -> int:
+        """The memory used by this Firefox instance, including its content processes"""
+        pid = self.driver.capabilities.get("moz:processID")
+        return _process_tree_rss(int(pid)) if pid else 0
+
+    def reset(self) -> None:
+        """Removes the state a visit left behind: extra tabs, and the data of every site
+
+        A visit can store data on any origin it navigates to, while a page can only
+        clear the storage of its own origin. So all site data is cleared from the
+        privileged context of Firefox instead, if that isn't allowed this raises and
+        the browser should be recycled.
+        """
+        handles = self.driver.window_handles
+        for handle in handles[1:]:
+            self.driver.switch_to.window(handle)
+            self.driver.close()
+        self.driver.switch_to.window(handles[0])
+        self.driver.get("about:blank")
+
+        with self.driver.context(self.driver.CONTEXT_CHROME):
+            self.driver.execute_async_script(CLEAR_SITE_DATA)
+
+    def quit(self) -> None:
+        """Quits the browser, ignoring a browser that already died"""
+        try:
+            self.driver.quit()
+        except WebDriverException:
+            pass
+
+
+class BrowserPool:  # pylint: disable=too-many-instance-attributes
+    """Keeps a number of set up browsers per challenge ready to be handed out
+
+    Args:
+        setups: The setup function of every challenge, by challenge name
+        pool_size: How many idle browsers to keep around per challenge
+        max_visits: After how many visits a browser is recycled
+        max_rss_mb: Above how many megabytes of memory a browser is recycled
+    """
+
+    def __init__(
+        self,
+        setups: dict[str, Callable[[webdriver.Firefox], None]],
+        pool_size: int = 1,
+        max_visits: int = 20,
+        max_rss_mb: int = 600,
+    ) -> None:
+        self.setups = setups
+        self.pool_size = pool_size
+        self.max_visits = max_visits
+        self.max_rss = max_rss_mb * 1024 * 1024
+
+        self.idle: dict[str, list[PooledBrowser]] = {name: [] for name in setups}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.recycled = 0
+
+    def launch(self, challenge: str) -> PooledBrowser:
+        """Starts a new Firefox instance and sets it up for the challenge"""
+        opts = Options()
+        opts.set_headless()
+
+        profile = webdriver.FirefoxProfile()
+        profile.DEFAULT_PREFERENCES["frozen"][  # type: ignore # pylint: disable=unsubscriptable-object
+            "network.cookie.cookieBehavior"
+        ] = 4
+        driver = webdriver.Firefox(options=opts, firefox_profile=profile)
+        driver.set_page_load_timeout(10)
+
+        browser = PooledBrowser(challenge, driver)
+        try:
+            self.prepare(browser)
+        except Exception:
+            browser.quit()
+            raise
+        return browser
+
+    def prepare(self, browser: PooledBrowser) -> None:
+        """Runs the challenge setup on a clean browser"""
+        browser.driver.delete_all_cookies()
+        self.setups[browser.challenge](browser.driver)
+        browser.driver.get("about:newtab")
+
+    def warm(self) -> None:
+        """Fills the pool of every challenge up to the pool size"""
+        for challenge in self.setups:
+            while True:
+                with self.lock:
+                    if len(self.idle[challenge]) >= self.pool_size:
+                        break
+                try:
+                    browser = self.launch(challenge)
+                except Exception:  # pylint: disable=broad-exception-caught
+                    logging.exception("Failed to warm a browser for %s", challenge)
+                    break
+                with self.lock:
+                    self.idle[challenge].append(browser)
+
+    def acquire(self, challenge: str) -> PooledBrowser:
+        """Hands out a set up browser for the challenge, launching one if none are idle"""
+        with self.lock:
+            if self.idle[challenge]:
+                self.hits += 1
+                return self.idle[challenge].pop()
+            self.misses += 1
+
+        logging.info("Browser pool for %s is empty, launching a new browser", challenge)
+        return self.launch(challenge)
+
+    def release(self, browser: PooledBrowser) -> None:
+        """Takes back a browser after a visit, resetting or recycling it"""
+        browser.visits += 1
+
+        with self.lock:
+            full = len(self.idle[browser.challenge]) >= self.pool_size
+        if full:
+            browser.quit()  # an extra browser launched on a miss, no room to keep it
+            return
+        if browser.visits >= self.max_visits or browser.rss() >= self.max_rss:
+            self.recycle(browser)
+            return
+
+        try:
+            browser.reset()
+            self.prepare(browser)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.exception("Failed to reset a browser for %s", browser.challenge)
+            self.recycle(browser)
+            return
+
+        with self.lock:
+            self.idle[browser.challenge].append(browser)
+
+    def recycle(self, browser: PooledBrowser) -> None:
+        """Quits a browser and launches a fresh one in its place"""
+        with self.lock:
+            self.recycled += 1
+        browser.quit()
+        self.warm()
+
+    def stats(self) -> dict[str, int]:
+        """Returns the pool size and the hit/miss counters"""
+        with self.lock:
+            return {
+                "idle": sum(len(browsers) for browsers in self.idle.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "recycled": self.recycled,
+            }
+
+    def close(self) -> None:
+        """Quits every idle browser"""
+        with self.lock:
+            browsers = [b for idle in self.idle.values() for b in idle]
+            for idle in self.idle.values():
+                idle.clear()
+        for browser in browsers:
+            browser.quit()
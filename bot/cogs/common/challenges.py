@@ -0,0 +1,64 @@
+"""This module defines how the browser is set up for each of the client-side challs
+
+Each setup function puts a browser in the state of the admin of the challenge, such
+as being logged in or having the flag stored, before it visits a link. Challenges with
+state that can expire on the server also have a check, telling whether a browser is
+still in that state.
+"""
+
+import base64
+import logging
+from collections.abc import Callable
+from urllib.parse import urlsplit
+
+from selenium import webdriver  # type: ignore
+
+try:
+    from ..ctf import corn as corn_secrets, exss as exss_secrets, mlb as mlb_secrets  # type: ignore
+except ImportError:
+    logging.warning("CTF module not found, using default values")
+    corn_secrets = {"password": "flag"}
+    exss_secrets = mlb_secrets = {"flag": "flag"}
+
+
+def corn(browser: webdriver.Firefox) -> None:
+    """This function sets up for the **corn** challenge"""
+    browser.get("http://challs.studsec.nl:5100/login")
+    username = browser.find_element_by_id("username")
+    password = browser.find_element_by_id("password")
+    username.send_keys("admin")
+    password.send_keys(corn_secrets["password"])
+    browser.find_element_by_name("login").click()
+
+
+def corn_logged_in(browser: webdriver.Firefox) -> bool:
+    """This function checks that the browser is still logged in to **corn**"""
+    browser.get("http://challs.studsec.nl:5100/")
+    return urlsplit(browser.current_url).path != "/login"
+
+
+def exss(browser: webdriver.Firefox) -> None:
+    """This function sets up for the **exss** challenge"""
+    browser.get(
+        "http://challs.studsec.nl:5080/?"
+        + base64.b64encode(exss_secrets["flag"].encode()).decode("ascii")
+    )
+
+
+def my_little_browser(browser: webdriver.Firefox) -> None:
+    """This function sets up for the **my little browser** challenge"""
+    browser.get(
+        "http://challs.studsec.nl:5480/?page="
+        + base64.b64encode(mlb_secrets["flag"].encode()).decode("ascii")
+    )
+
+
+CHALLENGES: dict[str, Callable[[webdriver.Firefox], None]] = {
+    "corn": corn,
+    "exss": exss,
+    "mlb": my_little_browser,
+}
+
+CHECKS: dict[str, Callable[[webdriver.Firefox], bool]] = {
+    "corn": corn_logged_in,
+}
@@ -0,0 +1,117 @@
+"""This module decides when a visited page is done, so a visit can end early.
+
+Instead of always waiting the full dwell time, the page is polled for activity: DOM
+mutations, finished and in-flight requests and pending timers. A visit ends when the
+page has been quiet for a while, when it navigated to another origin, or when the
+maximum dwell time is reached.
+
+Selenium can only inject the probe after the page loaded, so requests and timers
+started before that are only seen through the resource timing entries. Challenges
+relying on long delays should use a longer quiet window.
+"""
+
+import logging
+import time
+from urllib.parse import urlsplit
+
+from selenium import webdriver  # type: ignore
+from selenium.common.exceptions import WebDriverException  # type: ignore
+
+PROBE = """
+const limit = arguments[0];
+if (!window.__studbot) {
+    const state = window.__studbot = {mutated: performance.now(), pending: 0};
+    const track = (promise) => {
+        state.pending++;
+        const done = () => { state.pending--; state.mutated = performance.now(); };
+        promise.then(done, done);
+    };
+
+    new MutationObserver(() => { state.mutated = performance.now(); }).observe(
+        document, {subtree: true, childList: true, attributes: true, characterData: true}
+    );
+
+    const fetch = window.fetch;
+    window.fetch = function () {
+        const response = fetch.apply(this, arguments);
+        track(response);
+        return response;
+    };
+
+    const send = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function () {
+        track(new Promise((resolve) => this.addEventListener("loadend", resolve)));
+        return send.apply(this, arguments);
+    };
+
+    const setTimeout = window.setTimeout;
+    window.setTimeout = function (handler, delay) {
+        if ((delay || 0) <= limit) {
+            track(new Promise((resolve) => setTimeout(resolve, delay)));
+        }
+        return setTimeout.apply(this, arguments);
+    };
+}
+const resources = performance.getEntriesByType("resource");
+return {
+    href: location.href,
+    now: performance.now(),
+    active: Math.max(
+        window.__studbot.mutated,
+        ...resources.map((resource) => resource.responseEnd),
+    ),
+    pending: window.__studbot.pending,
+};
+"""
+
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def wait_for_completion(
+    driver: webdriver.Firefox,
+    max_dwell: float = 10.0,
+    quiet: float = 2.0,
+    min_dwell: float = 0.5,
+    poll: float = 0.1,
+) -> str:
+    """Waits until the page loaded in the browser is done doing things
+
+    Args:
+        driver: The browser that just loaded the page
+        max_dwell: The maximum amount of seconds to stay on the page
+        quiet: How many seconds without any activity count as done
+        min_dwell: The minimum amount of seconds to stay on the page
+        poll: How often to check the page, in seconds
+
+    Returns:
+        Why the visit ended: "quiet", "navigated" or "timeout"
+    """
+    start = time.monotonic()
+    origin = _origin(driver.current_url)
+
+    while time.monotonic() - start < max_dwell:
+        time.sleep(poll)
+
+        try:
+            state = driver.execute_script(PROBE, max_dwell * 1000)
+        except WebDriverException:
+            continue  # the page is navigating away, look again once it's loaded
+
+        if _origin(state["href"]) != origin:
+            reason = "navigated"
+        elif (
+            time.monotonic() - start >= min_dwell
+            and not state["pending"]
+            and state["now"] - state["active"] >= quiet * 1000
+        ):
+            reason = "quiet"
+        else:
+            continue
+
+        logging.info("Visit ended after %.1fs, %s", time.monotonic() - start, reason)
+        return reason
+
+    return "timeout"
@@ -0,0 +1,207 @@
+"""This module implements the database the bot and its cogs keep their state in.
+
+There is a single long-lived SQLite connection, used from one dedicated thread so
+queries never block the event loop and the connection's statement cache is reused.
+The database runs in WAL mode, and its schema is versioned with `PRAGMA user_version`:
+every migration below runs once, in order, in the same transaction as the version bump.
+"""
+
+from __future__ import annotations
+import asyncio
+import logging
+import os
+import sqlite3
+from collections.abc import Callable, Iterable, Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional, TypeVar, Union
+
+T = TypeVar("T")
+# The parameters of a statement, by position or by name
+Parameters = Union[Sequence[Any], Mapping[str, Any]]
+
+
+def columns(conn: sqlite3.Connection, table: str) -> list[str]:
+    """The column names of a table"""
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def create_events(conn: sqlite3.Connection) -> None:
+    """The Discord events and the calendar occurrences they were made for
+
+    Databases from before the migrations may already have the tables.
+    """
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS events "
+        + "(event_id INTEGER PRIMARY KEY, message_id INTEGER, is_preview INTEGER)"
+    )
+    if "uid" not in columns(conn, "events"):
+        conn.execute("ALTER TABLE events ADD COLUMN uid TEXT")
+        conn.execute("ALTER TABLE events ADD COLUMN recurrence_id TEXT")
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS events_uid ON events (uid, recurrence_id)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS occurrences "
+        + "(handler TEXT, uid TEXT, recurrence_id TEXT, fingerprint TEXT, "
+        + "start_time REAL, name TEXT, PRIMARY KEY (handler, uid, recurrence_id))"
+    )
+
+
+def create_pwncrates(conn: sqlite3.Connection) -> None:
+    """The state of the pwncrates integration and the scoreboard history"""
+    conn.execute(
+        "CREATE TABLE discord_ids "
+        + "(user_id INTEGER PRIMARY KEY, discord_id INTEGER, fetched REAL)"
+    )
+    conn.execute("CREATE INDEX discord_ids_discord_id ON discord_ids (discord_id)")
+    conn.execute(
+        "CREATE TABLE rank_roles (discord_id INTEGER PRIMARY KEY, role_id INTEGER)"
+    )
+    conn.execute("CREATE TABLE state (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE players (user_id INTEGER PRIMARY KEY, username TEXT)")
+    conn.execute("CREATE INDEX players_username ON players (username COLLATE NOCASE)")
+    conn.execute(
+        "CREATE TABLE score_history "
+        + "(user_id INTEGER, time REAL, position INTEGER, score INTEGER, "
+        + "PRIMARY KEY (user_id, time)) WITHOUT ROWID"
+    )
+
+
+def import_pwncrates(conn: sqlite3.Connection) -> None:
+    """Copies the tables of the pwncrates database the cog used to have for itself"""
+    path = os.path.join(
+        os.path.dirname(conn.execute("PRAGMA database_list").fetchone()[2]),
+        "pwncrates.db",
+    )
+    if not os.path.exists(path):
+        return
+
+    with sqlite3.connect(path) as old:
+        tables = {
+            row[0]
+            for row in old.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        }
+        for table in ("discord_ids", "rank_roles", "state", "players", "score_history"):
+            if table not in tables:
+                continue
+            names = ", ".join(columns(conn, table))
+            conn.executemany(
+                f"INSERT OR IGNORE INTO {table} ({names}) "
+                + f"VALUES ({', '.join('?' * len(columns(conn, table)))})",
+                old.execute(f"SELECT {names} FROM {table}"),
+            )
+    logging.info("Imported %s, it is no longer used", path)
+
+
+def add_vetoes(conn: sqlite3.Connection) -> None:
+    """The vetoes on preview announcements, unknown for the existing ones"""
+    conn.execute("ALTER TABLE events ADD COLUMN vetoes INTEGER")
+    conn.execute("CREATE INDEX events_message_id ON events (message_id)")
+
+
+MIGRATIONS: list[Callable[[sqlite3.Connection], None]] = [
+    create_events,
+    create_pwncrates,
+    import_pwncrates,
+    add_vetoes,
+]
+
+
+class Database:
+    """The connection to the database, used from a single thread off the event loop
+
+    Args:
+        path: The path of the database file
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self.conn: Optional[sqlite3.Connection] = None
+
+    async def start(self) -> None:
+        """Opens the connection and migrates the schema to the latest version"""
+        if not self.conn:
+            await self.run(self.open)
+
+    async def close(self) -> None:
+        """Closes the connection"""
+        if self.conn:
+            await self.run(self.conn.close)
+            self.conn = None
+        self.executor.shutdown()
+
+    def open(self) -> None:
+        """Opens the connection, on the database thread"""
+        # Transactions are explicit, see `transaction`
+        conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            logging.info("Migrating the database to version %d", number)
+
+            def migrate(conn, migration=migration, number=number):
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+
+            self.atomic(conn, migrate)
+        self.conn = conn
+
+    @staticmethod
+    def atomic(
+        conn: sqlite3.Connection, function: Callable[[sqlite3.Connection], T]
+    ) -> T:
+        """Calls a function with the connection, within a transaction"""
+        conn.execute("BEGIN")
+        try:
+            result = function(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    async def run(self, function: Callable[..., T], *args: Any) -> T:
+        """Calls a function on the database thread"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
+
+    async def transaction(self, function: Callable[[sqlite3.Connection], T]) -> T:
+        """Calls a function with the connection, within a single transaction
+
+        This is how writes are batched, everything the function does is committed at
+        once or, if it raises, not at all.
+        """
+        assert self.conn
+        return await self.run(self.atomic, self.conn, function)
+
+    async def execute(self, sql: str, parameters: Parameters = ()) -> None:
+        """Executes a single statement"""
+        await self.transaction(lambda conn: conn.execute(sql, parameters))
+
+    async def executemany(self, sql: str, parameters: Iterable[Parameters]) -> None:
+        """Executes a statement for every set of parameters, in one transaction"""
+        rows = list(parameters)
+        await self.transaction(lambda conn: conn.executemany(sql, rows))
+
+    async def fetchone(
+        self, sql: str, parameters: Parameters = ()
+    ) -> Optional[sqlite3.Row]:
+        """Returns the first row of a query"""
+        assert self.conn
+        conn = self.conn
+        return await self.run(lambda: conn.execute(sql, parameters).fetchone())
+
+    async def fetchall(
+        self, sql: str, parameters: Parameters = ()
+    ) -> list[sqlite3.Row]:
+        """Returns all rows of a query"""
+        assert self.conn
+        conn = self.conn
+        return await self.run(lambda: conn.execute(sql, parameters).fetchall())
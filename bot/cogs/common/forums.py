@@ -0,0 +1,99 @@
+"""This module implements an index of the CTF categories, forums and General threads.
+
+Every CTF gets a forum in the `CTFs - <year>` category, with a General thread. Instead
+of searching the guild's channels for these on every join or leave, the index is
+built once and then kept up to date from the channel and thread gateway events.
+"""
+
+from __future__ import annotations
+import re
+from typing import Optional, Union
+
+from discord import CategoryChannel, Guild, Thread
+from discord.abc import GuildChannel
+from discord.channel import ForumChannel
+
+CATEGORY = re.compile(r"CTFs - (\d{4})")
+
+
+def normalise(name: str) -> str:
+    """The name of the forum of a CTF, as Discord stores it"""
+    return name.lower().replace(" ", "-")
+
+
+class ForumIndex:
+    """Maps CTFs to the ids of their forum and General thread"""
+
+    def __init__(self) -> None:
+        self.built = False
+        self.categories: dict[int, int] = {}  # year -> category id
+        self.forums: dict[tuple[int, str], int] = {}  # (year, name) -> forum id
+        self.names: dict[int, tuple[int, str]] = {}  # forum id -> (year, name)
+        self.generals: dict[int, int] = {}  # forum id -> thread id
+
+    def build(self, guild: Guild) -> None:
+        """Indexes all the CTF categories of a guild"""
+        self.categories.clear()
+        self.forums.clear()
+        self.names.clear()
+        self.generals.clear()
+        for category in guild.categories:
+            self.add(category)
+        self.built = True
+
+    def category(self, year: int) -> Optional[int]:
+        """The id of the category of a year"""
+        return self.categories.get(year)
+
+    def forum(self, year: int, name: str) -> Optional[int]:
+        """The id of the forum of a CTF"""
+        return self.forums.get((year, normalise(name)))
+
+    def general(self, forum_id: int) -> Optional[int]:
+        """The id of the General thread of a forum"""
+        return self.generals.get(forum_id)
+
+    def add(self, channel: Union[GuildChannel, Thread]) -> None:
+        """Indexes a channel or thread, if it is part of a CTF"""
+        if isinstance(channel, CategoryChannel):
+            if match := CATEGORY.fullmatch(channel.name):
+                self.categories[int(match[1])] = channel.id
+                for forum in channel.forums:
+                    self.add(forum)
+        elif isinstance(channel, ForumChannel):
+            if channel.category and (
+                match := CATEGORY.fullmatch(channel.category.name)
+            ):
+                key = (int(match[1]), normalise(channel.name))
+                self.forums[key] = channel.id
+                self.names[channel.id] = key
+                for thread in channel.threads:
+                    self.add(thread)
+        elif isinstance(channel, Thread):
+            if channel.name == "General" and channel.parent_id in self.names:
+                self.generals[channel.parent_id] = channel.id
+
+    def remove(self, channel: Union[GuildChannel, Thread]) -> None:
+        """Removes a channel or thread, and everything below it, from the index"""
+        if isinstance(channel, CategoryChannel):
+            year = next((y for y, i in self.categories.items() if i == channel.id), 0)
+            self.categories.pop(year, None)
+            for forum_id in [i for i, (y, _) in self.names.items() if y == year]:
+                self.forums.pop(self.names.pop(forum_id), None)
+                self.generals.pop(forum_id, None)
+        elif channel.id in self.names:
+            self.forums.pop(self.names.pop(channel.id), None)
+            self.generals.pop(channel.id, None)
+        elif isinstance(channel, Thread) and (
+            self.generals.get(channel.parent_id) == channel.id
+        ):
+            del self.generals[channel.parent_id]
+
+    def update(
+        self,
+        before: Union[GuildChannel, Thread],
+        after: Union[GuildChannel, Thread],
+    ) -> None:
+        """Indexes a channel or thread again after it was renamed or moved"""
+        self.remove(before)
+        self.add(after)
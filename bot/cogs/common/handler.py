@@ -1,13 +1,31 @@
 """This module implements the Handler classes, which handle events of a specific type."""
 
 from __future__ import annotations
+import asyncio
 import logging
-import sqlite3
+import traceback
+from typing import Any, Optional, Union
 
 from datetime import datetime, timedelta
-from discord import Guild, ScheduledEvent, User, PermissionOverwrite, EntityType
+from discord import (
+    CategoryChannel,
+    EntityType,
+    Guild,
+    PermissionOverwrite,
+    Message,
+    NotFound,
+    RawReactionActionEvent,
+    RawReactionClearEmojiEvent,
+    RawReactionClearEvent,
+    ScheduledEvent,
+    TextChannel,
+    User,
+)
 from discord.channel import ForumChannel
 
+from .forums import ForumIndex  # type: ignore
+from .scheduler import BACKGROUND, USER  # type: ignore
+
 
 class Handler:
     """A base class that represents the handler for a specific event type."""
@@ -17,19 +35,58 @@ class Handler:
         self.event_type = event_type
         self.calendar_url = calendar_url
         self.delta_days = delta_days
+        self.writes = bot.writes
 
     async def handle_event(
-        self, guild: Guild, event_data: dict, scheduled_event: ScheduledEvent
-    ):
-        """Handles events by creating and updating Discord events."""
+        self,
+        guild: Guild,
+        event_data: dict,
+        scheduled_event: Optional[ScheduledEvent],
+    ) -> Optional[ScheduledEvent]:
+        """Handles events by creating and updating Discord events.
+
+        Returns:
+            The Discord event that now represents the calendar event, if any
+        """
         raise NotImplementedError
 
+    def state(self, event_data: dict) -> str:  # pylint: disable=unused-argument
+        """Describes the time dependent state an event is handled in
+
+        Events are only handled again when their data or this state changed.
+        """
+        return ""
+
+    async def remove_event(
+        self, guild: Guild, scheduled_event: Optional[ScheduledEvent]
+    ):
+        """Handles an event that was removed from the calendar"""
+
     async def event_user_manage(self, event: ScheduledEvent, user: User, read: bool):
         """Manages users being added or removed from a channel"""
 
     async def event_delete(self, event: ScheduledEvent):
         """Deletes an event"""
 
+    async def bootstrap(self, guild: Guild):
+        """Catches up on what changed while the bot was offline, before the first update"""
+
+    async def reaction_change(self, payload: RawReactionActionEvent, added: bool):
+        """Keeps track of a reaction that was added or removed"""
+
+    async def reaction_clear(
+        self, payload: Union[RawReactionClearEvent, RawReactionClearEmojiEvent]
+    ):
+        """Keeps track of all reactions, or all of one emoji, being removed at once"""
+
+    def channel_change(self, before, after):
+        """Keeps track of a channel or thread that was created, updated or deleted
+
+        Args:
+            before: The channel before the change, None if it was created
+            after: The channel after the change, None if it was deleted
+        """
+
     @staticmethod
     def get_handlers(bot) -> list[Handler]:
         """Return a list of all Handler instances for the bot."""
@@ -42,12 +99,21 @@ class Handler:
 class CTFHandler(Handler):
     """A class that represents the handler for CTF events."""
 
+    # failed edits in a row after which the collected joins and leaves are dropped
+    ATTEMPTS = 3
+
     def __init__(self, bot, calendar_url: str, event_type="CTF", delta_days=30):
         super().__init__(bot, calendar_url, event_type, delta_days)
+        self.forums = ForumIndex()
+        self.pending: dict[int, dict[int, tuple[User, bool]]] = {}
+        self.flushes: set[asyncio.Task] = set()
 
     async def handle_event(
-        self, guild: Guild, event_data: dict, scheduled_event: ScheduledEvent
-    ):
+        self,
+        guild: Guild,
+        event_data: dict,
+        scheduled_event: Optional[ScheduledEvent],
+    ) -> Optional[ScheduledEvent]:
         """Handles CTF-specific events by creating and updating Discord events and channels."""
         if not scheduled_event:
             # This is a bit of a conflict, in the calendar we just want the days of
@@ -55,80 +121,203 @@ class CTFHandler(Handler):
             # But the event itself we might want to manually update the times.
             # Because of this, we don't make the event editable after creation.
 
-            await guild.create_scheduled_event(**event_data)
+            scheduled_event = await self.writes.submit(
+                lambda: guild.create_scheduled_event(**event_data),
+                "scheduled_events",
+                USER,
+            )
             logging.info("Created CTF event for %s", event_data["name"])
 
-            for channel_category, _ in guild.by_category():
-                if (
-                    channel_category
-                    and channel_category.name
-                    == f"CTFs - {event_data['start_time'].strftime('%Y')}"
-                ):
-                    category = channel_category
-                    break
-            else:
-                category = await guild.create_category(
-                    f"CTFs - {event_data['start_time'].strftime('%Y')}"
+            forums = self.index(guild)
+            year = event_data["start_time"].year
+            category = guild.get_channel(forums.category(year) or 0)
+            if not isinstance(category, CategoryChannel):
+                category = await self.writes.submit(
+                    lambda: guild.create_category(f"CTFs - {year}"),
+                    "channels",
+                    key=("category", year),
                 )
+                forums.add(category)
 
-            if event_data["name"].lower().replace(" ", "-") in [
-                f.name for f in category.forums
-            ]:
+            if forums.forum(year, event_data["name"]):
                 # there already is a forum for this
-                return
+                return scheduled_event
 
             overwrites = {
                 guild.default_role: PermissionOverwrite(read_messages=False),
             }
-            forum = await category.create_forum(
-                event_data["name"], overwrites=overwrites
+            forum = await self.writes.submit(
+                lambda: category.create_forum(
+                    event_data["name"], overwrites=overwrites
+                ),
+                "channels",
             )
+            forums.add(forum)
 
-            await forum.create_thread(
-                name="General",
-                content=f"General discussion thread for {event_data['name']}",
+            general = await self.writes.submit(
+                lambda: forum.create_thread(
+                    name="General",
+                    content=f"General discussion thread for {event_data['name']}",
+                ),
+                f"threads:{forum.id}",
             )
+            forums.add(general.thread)
             logging.info("Created CTF forum for %s", event_data["name"])
 
             # Add tags, this can be done in the forum creation but this is more readable.
-            await forum.create_tag(name="busy")
-            await forum.create_tag(name="done")
-            await forum.create_tag(name="stuck")
+            # Nobody needs them right away, so they go after other work.
+            await asyncio.gather(
+                *(
+                    self.writes.submit(
+                        lambda name=name: forum.create_tag(name=name),
+                        f"channel:{forum.id}",
+                        BACKGROUND,
+                    )
+                    for name in ("busy", "done", "stuck")
+                )
+            )
+
+        return scheduled_event
 
     async def event_user_manage(self, event: ScheduledEvent, user: User, read):
         """Manages users being added or removed from a channel"""
         if not event.guild:
             return
 
-        for category, channels in event.guild.by_category():
-            if (
-                not category
-                or category.name != f"CTFs - {event.start_time.strftime('%Y')}"
-            ):
-                continue
-
-            if forum := next(
-                (c for c in channels if c.name == event.name.replace(" ", "-").lower()),
-                None,
-            ):
-                if not isinstance(forum, ForumChannel):
-                    continue
-
-                await forum.set_permissions(user, read_messages=read)  # type: ignore
-                if (
-                    general := next(
-                        (t for t in forum.threads if t.name == "General"), None
+        forums = self.index(event.guild)
+        forum = event.guild.get_channel(
+            forums.forum(event.start_time.year, event.name) or 0
+        )
+        if not isinstance(forum, ForumChannel):
+            return
+
+        # Joins and leaves are collected for a short while and applied at once, the
+        # last one of a user wins. They stay collected until their edit succeeded.
+        if forum.id not in self.pending:
+            self.pending[forum.id] = {}
+            task = asyncio.create_task(self.apply_permissions(forum.id))
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+        self.pending[forum.id][user.id] = (user, read)
+
+    async def apply_permissions(self, forum_id: int):
+        """Applies the collected joins and leaves of a forum, until there are none
+
+        A failed edit is tried again with the joins and leaves that came in since,
+        after `ATTEMPTS` failures in a row they are dropped.
+        """
+        failures = 0
+        while self.pending.get(forum_id):
+            await asyncio.sleep(self.bot.config["events"]["join_window"])
+            try:
+                await self.flush_permissions(forum_id)
+                failures = 0
+            except Exception:  # pylint: disable=broad-exception-caught
+                failures += 1
+                logging.error(
+                    "Failed to apply the joins and leaves of forum %d:\n%s",
+                    forum_id,
+                    traceback.format_exc(),
+                )
+                if failures == self.ATTEMPTS:
+                    logging.error(
+                        "Dropped %d joins and leaves of forum %d",
+                        len(self.pending[forum_id]),
+                        forum_id,
                     )
-                ) and read:
-                    await general.add_user(user)
+                    self.pending[forum_id].clear()
+        self.pending.pop(forum_id, None)
+
+    async def flush_permissions(self, forum_id: int):
+        """Edits the overwrites of a forum, then adds the joined users to General"""
+        forum = self.bot.get_channel(forum_id)
+        if not isinstance(forum, ForumChannel):
+            self.pending[forum_id].clear()
+            return
 
-                logging.info(
-                    "%s %s to CTF %s",
-                    ("Added" if read else "Removed"),
-                    user.name,
-                    event.name,
+        changed = await self.writes.submit(
+            lambda: self.edit_permissions(forum), f"channel:{forum_id}", USER
+        )
+        if not changed:
+            return
+        logging.info(
+            "Added %d and removed %d users to CTF %s",
+            sum(read for _, read in changed),
+            sum(not read for _, read in changed),
+            forum.name,
+        )
+
+        general = forum.get_thread(self.forums.general(forum.id) or 0)
+        if not general:
+            return
+        # one route for the thread, so the adds are paced by the scheduler
+        joined = [user for user, read in changed if read]
+        results = await asyncio.gather(
+            *(
+                self.writes.submit(
+                    lambda user=user: general.add_user(user),
+                    f"threads:{general.id}",
+                    USER,
+                )
+                for user in joined
+            ),
+            return_exceptions=True,
+        )
+        for user, result in zip(joined, results):
+            if isinstance(result, BaseException):
+                logging.error(
+                    "Failed to add %s to the General thread of CTF %s: %r",
+                    user,
+                    forum.name,
+                    result,
                 )
 
+    async def edit_permissions(self, forum: ForumChannel) -> list[tuple[User, bool]]:
+        """Edits the overwrites of a forum with the joins and leaves collected so far
+
+        This runs once the scheduler gets to the edit, so the joins and leaves that
+        came in while it was queued are part of it, and it starts from the overwrites
+        the forum has by then. They are only taken out of the collected ones once the
+        edit succeeded, so a retried edit still has them.
+
+        Returns:
+            The users whose overwrite changed, and whether they can read the forum now
+        """
+        pending = self.pending.get(forum.id, {})
+        users = dict(pending)
+
+        # keyed by users as well, discord.py only types roles, members and objects
+        overwrites: dict[Any, PermissionOverwrite] = dict(forum.overwrites)
+        changed = []
+        for user, read in users.values():
+            overwrite = overwrites.get(user, PermissionOverwrite())
+            if bool(overwrite.read_messages) is read:
+                continue  # joined and left again, or the other way around
+            overwrite.update(read_messages=read)
+            overwrites[user] = overwrite
+            changed.append((user, read))
+        if changed:
+            await forum.edit(overwrites=overwrites)
+        for user_id, entry in users.items():
+            if pending.get(user_id) is entry:
+                del pending[user_id]  # not joined or left again in the meantime
+        return changed
+
+    def index(self, guild: Guild) -> ForumIndex:
+        """The index of the CTF forums, built on first use"""
+        if not self.forums.built:
+            self.forums.build(guild)
+        return self.forums
+
+    def channel_change(self, before, after):
+        """Keeps the index of the CTF forums up to date"""
+        if not self.forums.built:
+            return
+        if before:
+            self.forums.remove(before)
+        if after:
+            self.forums.add(after)
+
 
 class CalendarHandler(Handler):
     """A class that represents the handler for calendar events."""
@@ -146,17 +335,9 @@ class CalendarHandler(Handler):
             description=event_data["description"],
         )
 
-    async def handle_event(
-        self, guild: Guild, event_data: dict, scheduled_event: ScheduledEvent
-    ):
-        """Handles calendar events by creating and updating Discord events, possibly a preview."""
-        if event_data["start_time"] - timedelta(hours=3) < datetime.now(
-            event_data["start_time"].tzinfo
-        ):
-            # Do not edit events 3 hours before the event takes place
-            return
-
-        channel_name = (
+    def _channel_name(self, event_data: dict) -> str:
+        """The name of the channel to announce in, the preview channel until a day in"""
+        return (
             self.bot.config["private"]["channels"][0]
             if (
                 event_data["start_time"] - timedelta(days=self.delta_days - 1)
@@ -164,14 +345,36 @@ class CalendarHandler(Handler):
             )
             else self.bot.config["public"]["channels"][0]
         )
-        channel = guild.get_channel(self.bot.channels[channel_name])
+
+    @staticmethod
+    def _locked(event_data: dict) -> bool:
+        """Whether the event is too close to its start to be edited"""
+        return event_data["start_time"] - timedelta(hours=3) < datetime.now(
+            event_data["start_time"].tzinfo
+        )
+
+    def state(self, event_data: dict) -> str:
+        """Events are handled again when they go public, and when they get locked"""
+        return "locked" if self._locked(event_data) else self._channel_name(event_data)
+
+    async def handle_event(
+        self,
+        guild: Guild,
+        event_data: dict,
+        scheduled_event: Optional[ScheduledEvent],
+    ) -> Optional[ScheduledEvent]:
+        """Handles calendar events by creating and updating Discord events, possibly a preview."""
+        if self._locked(event_data):
+            # Do not edit events 3 hours before the event takes place
+            return scheduled_event
+
+        channel = guild.get_channel(self.bot.channels[self._channel_name(event_data)])
 
         if scheduled_event:
-            await self._handle_existing_event(
+            return await self._handle_existing_event(
                 guild, event_data, scheduled_event, channel
             )
-        else:
-            await self._create_event(guild, event_data, channel)
+        return await self._create_event(guild, event_data, channel)
 
     async def _handle_existing_event(
         self,
@@ -179,14 +382,11 @@ class CalendarHandler(Handler):
         event_data: dict,
         scheduled_event: ScheduledEvent,
         channel,
-    ):
+    ) -> Optional[ScheduledEvent]:
         """Handles existing events by updating or deleting them"""
-        with sqlite3.connect(f"{self.bot.shared}/events.db") as conn:
-            conn.row_factory = sqlite3.Row
-            row = conn.execute(
-                "SELECT * FROM events WHERE event_id = ?",
-                (scheduled_event.id,),
-            ).fetchone()
+        row = await self.bot.db.fetchone(
+            "SELECT * FROM events WHERE event_id = ?", (scheduled_event.id,)
+        )
 
         if row and channel.name == "announcements" and row["is_preview"]:
             # The event was a preview event and should be deleted
@@ -194,38 +394,57 @@ class CalendarHandler(Handler):
                 self.bot.channels[self.bot.config["private"]["channels"][0]]
             )
 
-            message = await channel.fetch_message(row["message_id"])
-            if message.reactions[0].count > 1:
+            vetoes = row["vetoes"]
+            if vetoes is None:
+                # announced before vetoes were tracked, count them once
+                vetoes = self.count_vetoes(
+                    await channel.fetch_message(row["message_id"])
+                )
+                await self.bot.db.execute(
+                    "UPDATE events SET vetoes = ? WHERE event_id = ?",
+                    (vetoes, scheduled_event.id),
+                )
+            if vetoes > 0:
                 logging.info(
                     "Event %s has been blocked, not making public",
                     event_data["name"],
                 )
-                return
-            await message.delete()
+                return scheduled_event
 
-            await scheduled_event.delete()
-            with sqlite3.connect(f"{self.bot.shared}/events.db") as conn:
-                conn.execute(
-                    "DELETE FROM events WHERE event_id = ?", (scheduled_event.id,)
-                )
+            message = channel.get_partial_message(row["message_id"])
+            await self.writes.submit(message.delete, f"messages:{channel.id}")
+            await self.writes.submit(scheduled_event.delete, "scheduled_events")
+            await self.bot.db.execute(
+                "DELETE FROM events WHERE event_id = ?", (scheduled_event.id,)
+            )
 
             logging.info(
                 "Removed preview event %s to announce in announcements",
                 event_data["name"],
             )
-            return
+            return None
 
         # Edit the existing event, message too if it is present in the DB
-        if row:
-            message = await channel.fetch_message(row["message_id"])
-            await message.edit(
-                content=self.format_announcement(
-                    self.bot.config, event_data, scheduled_event.url
-                )
+        if row and row["message_id"]:
+            message = channel.get_partial_message(row["message_id"])
+            await self.writes.submit(
+                lambda: message.edit(
+                    content=self.format_announcement(
+                        self.bot.config, event_data, scheduled_event.url
+                    )
+                ),
+                f"messages:{channel.id}",
+                key=("message", message.id),
             )
-        await scheduled_event.edit(**event_data)
+        return await self.writes.submit(
+            lambda: scheduled_event.edit(**event_data),
+            "scheduled_events",
+            key=("scheduled_event", scheduled_event.id),
+        )
 
-    async def _create_event(self, guild: Guild, event_data: dict, channel):
+    async def _create_event(
+        self, guild: Guild, event_data: dict, channel
+    ) -> ScheduledEvent:
         """Creates an event in the guild, either as a private preview or as a public announcement"""
         reaction = None
 
@@ -242,28 +461,171 @@ class CalendarHandler(Handler):
 
         logging.info("Creating event %s in %s", event_data["name"], channel.name)
 
-        event = await guild.create_scheduled_event(**event_data)
-        message = await channel.send(
-            self.format_announcement(self.bot.config, event_data, event.url)
+        event = await self.writes.submit(
+            lambda: guild.create_scheduled_event(**event_data),
+            "scheduled_events",
+            USER,
+        )
+        message = await self.writes.submit(
+            lambda: channel.send(
+                self.format_announcement(self.bot.config, event_data, event.url)
+            ),
+            f"messages:{channel.id}",
+            USER,
         )
 
         if reaction:
-            await message.add_reaction(reaction)
-
-        with sqlite3.connect(f"{self.bot.shared}/events.db") as conn:
-            conn.execute(
-                "INSERT INTO events (event_id, message_id, is_preview) VALUES (?, ?, ?)",
-                (
-                    event.id,
-                    message.id,
-                    1 if channel.name in self.bot.config["private"]["channels"] else 0,
-                ),
+            await self.writes.submit(
+                lambda: message.add_reaction(reaction),
+                f"reactions:{channel.id}",
+                USER,
             )
 
+        await self.bot.db.execute(
+            "INSERT INTO events (event_id, message_id, is_preview, vetoes) "
+            + "VALUES (?, ?, ?, 0)",
+            (
+                event.id,
+                message.id,
+                1 if channel.name in self.bot.config["private"]["channels"] else 0,
+            ),
+        )
+
         logging.info("Created event %s in %s", event_data["name"], channel.name)
+        return event
 
-    async def event_delete(self, event: ScheduledEvent):
-        """Deletes an event"""
-        with sqlite3.connect(f"{self.bot.shared}/events.db") as conn:
-            conn.execute("DELETE FROM events WHERE event_id = ?", (event.id,))
-        logging.info("Deleted event %s", event.name)
+    @staticmethod
+    def count_vetoes(message: Message) -> int:
+        """The vetoes on an announcement, the reaction of the bot itself not included"""
+        reaction = next((r for r in message.reactions if str(r.emoji) == "🛑"), None)
+        if not reaction:
+            return 0
+        return reaction.count - 1 if reaction.me else reaction.count
+
+    def _is_preview_channel(self, channel_id: int) -> bool:
+        """Whether a channel is the one previews are announced in"""
+        return channel_id == self.bot.channels.get(
+            self.bot.config["private"]["channels"][0]
+        )
+
+    def _vetoes_changed(self, conn, message_id: int) -> None:
+        """Makes the event of an announcement be handled again, within a transaction"""
+        conn.execute(
+            "UPDATE occurrences SET fingerprint = NULL WHERE handler = ? AND "
+            + "(uid, recurrence_id) IN "
+            + "(SELECT uid, recurrence_id FROM events WHERE message_id = ?)",
+            (self.event_type, message_id),
+        )
+
+    async def bootstrap(self, guild: Guild):
+        """Counts the vetoes on the open previews again
+
+        Reactions added or removed while the bot was offline never reached it.
+        """
+        channel = guild.get_channel(
+            self.bot.channels[self.bot.config["private"]["channels"][0]]
+        )
+        if not isinstance(channel, TextChannel):
+            return
+        rows = await self.bot.db.fetchall(
+            "SELECT message_id, vetoes FROM events "
+            + "WHERE is_preview = 1 AND message_id IS NOT NULL"
+        )
+        messages = await asyncio.gather(
+            *(channel.fetch_message(row["message_id"]) for row in rows),
+            return_exceptions=True,
+        )
+
+        counted = []
+        for row, message in zip(rows, messages):
+            if isinstance(message, NotFound):
+                continue  # deleted, handled like any other preview
+            if isinstance(message, BaseException):
+                raise message
+            vetoes = self.count_vetoes(message)
+            if vetoes != row["vetoes"]:
+                counted.append((vetoes, row["message_id"]))
+
+        def store(conn):
+            for vetoes, message_id in counted:
+                conn.execute(
+                    "UPDATE events SET vetoes = ? WHERE message_id = ?",
+                    (vetoes, message_id),
+                )
+                self._vetoes_changed(conn, message_id)
+
+        if counted:
+            await self.bot.db.transaction(store)
+            logging.info("Recounted the vetoes of %d previews", len(counted))
+
+    async def reaction_change(self, payload: RawReactionActionEvent, added: bool):
+        """Counts the vetoes on preview announcements
+
+        An event is handled again once its vetoes changed, so lifting the last veto
+        makes it public, and a late veto can still block it.
+        """
+        if (
+            str(payload.emoji) != "🛑"
+            or payload.user_id == self.bot.user.id
+            or not self._is_preview_channel(payload.channel_id)
+        ):
+            return
+
+        def count(conn):
+            updated = conn.execute(
+                "UPDATE events SET vetoes = MAX(vetoes + ?, 0) "
+                + "WHERE message_id = ? AND is_preview = 1",
+                (1 if added else -1, payload.message_id),
+            ).rowcount
+            self._vetoes_changed(conn, payload.message_id)
+            return updated
+
+        if await self.bot.db.transaction(count):
+            logging.info(
+                "Veto %s on event announcement %d",
+                "added" if added else "removed",
+                payload.message_id,
+            )
+
+    async def reaction_clear(
+        self, payload: Union[RawReactionClearEvent, RawReactionClearEmojiEvent]
+    ):
+        """Lifts all vetoes of a preview announcement whose reactions were removed"""
+        if (
+            isinstance(payload, RawReactionClearEmojiEvent)
+            and str(payload.emoji) != "🛑"
+        ) or not self._is_preview_channel(payload.channel_id):
+            return
+
+        def clear(conn):
+            updated = conn.execute(
+                "UPDATE events SET vetoes = 0 WHERE message_id = ? AND is_preview = 1",
+                (payload.message_id,),
+            ).rowcount
+            self._vetoes_changed(conn, payload.message_id)
+            return updated
+
+        if await self.bot.db.transaction(clear):
+            logging.info("Vetoes cleared on event announcement %d", payload.message_id)
+
+    async def remove_event(
+        self, guild: Guild, scheduled_event: Optional[ScheduledEvent]
+    ):
+        """Deletes the Discord event, and its announcement if it was only a preview"""
+        if not scheduled_event:
+            return
+
+        row = await self.bot.db.fetchone(
+            "SELECT * FROM events WHERE event_id = ?", (scheduled_event.id,)
+        )
+
+        if row and row["is_preview"] and row["message_id"]:
+            channel = guild.get_channel(
+                self.bot.channels[self.bot.config["private"]["channels"][0]]
+            )
+            if isinstance(channel, TextChannel):
+                message = channel.get_partial_message(row["message_id"])
+                await self.writes.submit(message.delete, f"messages:{channel.id}")
+
+        # the database row is removed when Discord tells us the event was deleted
+        await self.writes.submit(scheduled_event.delete, "scheduled_events")
@@ -0,0 +1,108 @@
+"""This module implements the local history of the pwncrates scoreboard.
+
+Every fetched scoreboard is stored, but only the users whose position or score changed
+get a new row. Rows are clustered by user and time, so the state of a user at any
+point in time is a single index lookup.
+"""
+
+from __future__ import annotations
+import time
+from typing import Optional
+
+from .database import Database  # type: ignore
+
+
+class ScoreHistory:
+    """The scoreboard history, stored in the `players` and `score_history` tables
+
+    Args:
+        db: The database of the bot
+    """
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+        # user_id -> (username, position, score), as last stored
+        self.latest: dict[int, tuple[str, int, int]] = {}
+
+    async def load(self) -> None:
+        """Loads the last stored state of every user"""
+        self.latest = {
+            user_id: (username, position, score)
+            for user_id, username, position, score, _ in await self.db.fetchall(
+                "SELECT h.user_id, p.username, h.position, h.score, MAX(h.time) "
+                + "FROM score_history h JOIN players p USING (user_id) "
+                + "GROUP BY h.user_id"
+            )
+        }
+
+    async def record(self, scoreboard: list[dict]) -> int:
+        """Stores the users of a scoreboard whose position or score changed
+
+        Returns:
+            The number of users that changed
+        """
+        now = time.time()
+        players, history = [], []
+        for user in scoreboard:
+            username, position, score = (
+                user["username"],
+                int(user["position"]),
+                int(user["score"]),
+            )
+            latest = self.latest.get(user["user_id"])
+            if latest == (username, position, score):
+                continue
+
+            self.latest[user["user_id"]] = (username, position, score)
+            if not latest or latest[0] != username:
+                players.append((user["user_id"], username))
+            if not latest or latest[1:] != (position, score):
+                history.append((user["user_id"], now, position, score))
+
+        def store(conn):
+            conn.executemany(
+                "INSERT OR REPLACE INTO players (user_id, username) VALUES (?, ?)",
+                players,
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO score_history (user_id, time, position, score) "
+                + "VALUES (?, ?, ?, ?)",
+                history,
+            )
+
+        if players or history:
+            await self.db.transaction(store)
+        return len(history)
+
+    async def find_user(self, username: str) -> Optional[tuple[int, str]]:
+        """Looks up a user by their username, ignoring case"""
+        row = await self.db.fetchone(
+            "SELECT user_id, username FROM players WHERE username = ? COLLATE NOCASE",
+            (username,),
+        )
+        return (row["user_id"], row["username"]) if row else None
+
+    async def find_discord_user(self, discord_id: int) -> Optional[tuple[int, str]]:
+        """Looks up a user by their linked discord id, as far as it is cached"""
+        row = await self.db.fetchone(
+            "SELECT user_id, username FROM players WHERE user_id = "
+            + "(SELECT user_id FROM discord_ids WHERE discord_id = ?)",
+            (discord_id,),
+        )
+        return (row["user_id"], row["username"]) if row else None
+
+    async def lookup(self, user_id: int, when: float) -> Optional[tuple[int, int]]:
+        """Returns the position and score of a user at a point in time
+
+        If the user wasn't on the scoreboard yet, their first entry is returned.
+        """
+        row = await self.db.fetchone(
+            "SELECT position, score FROM score_history WHERE user_id = ? "
+            + "AND time <= ? ORDER BY time DESC LIMIT 1",
+            (user_id, when),
+        ) or await self.db.fetchone(
+            "SELECT position, score FROM score_history WHERE user_id = ? "
+            + "ORDER BY time LIMIT 1",
+            (user_id,),
+        )
+        return (row["position"], row["score"]) if row else None
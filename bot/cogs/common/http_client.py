@@ -0,0 +1,113 @@
+"""This module implements the asynchronous HTTP client used to talk to external APIs.
+
+A single `aiohttp` session is kept per client, so connections are reused between
+requests instead of doing a new TCP/TLS handshake every time. Failed requests are
+retried with exponential backoff. Conditional requests remember the ETag and
+Last-Modified validators of every url, so unchanged resources aren't downloaded again.
+"""
+
+from __future__ import annotations
+import asyncio
+import json
+import logging
+from typing import Any, Optional
+
+import aiohttp
+
+
+class HttpError(Exception):
+    """Raised when a request still fails after all its retries"""
+
+
+class HttpClient:
+    """A keep-alive HTTP client with per-request timeouts and retries
+
+    Args:
+        timeout: The total amount of seconds a single request may take
+        retries: How many times a failed request is retried
+        backoff: The seconds to wait before the first retry, doubling every retry
+        connections: The maximum amount of simultaneous connections
+    """
+
+    def __init__(
+        self,
+        timeout: float = 10,
+        retries: int = 2,
+        backoff: float = 0.5,
+        connections: int = 10,
+    ) -> None:
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.connections = connections
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.validators: dict[str, dict[str, str]] = {}
+
+    async def start(self) -> None:
+        """Opens the session, this needs to be done from within the event loop"""
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.connections, keepalive_timeout=60
+            ),
+            timeout=self.timeout,
+        )
+
+    async def close(self) -> None:
+        """Closes the session and all its connections"""
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def get(self, url: str, conditional: bool = False) -> Optional[bytes]:
+        """Gets the body of a url
+
+        Args:
+            url: The url to get
+            conditional: Whether to send the validators of the previous response
+
+        Returns:
+            The body, or None for a conditional request of an unchanged resource
+
+        Raises:
+            HttpError: If the request failed after all retries
+        """
+        if not self.session:
+            await self.start()
+        assert self.session
+
+        headers = {}
+        if conditional and url in self.validators:
+            if "ETag" in self.validators[url]:
+                headers["If-None-Match"] = self.validators[url]["ETag"]
+            if "Last-Modified" in self.validators[url]:
+                headers["If-Modified-Since"] = self.validators[url]["Last-Modified"]
+
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.get(url, headers=headers) as response:
+                    if response.status == 304 and headers:
+                        return None
+                    response.raise_for_status()
+
+                    self.validators[url] = {
+                        header: response.headers[header]
+                        for header in ("ETag", "Last-Modified")
+                        if header in response.headers
+                    }
+                    return await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                retry = attempt < self.retries
+                if isinstance(error, aiohttp.ClientResponseError):
+                    retry = retry and error.status >= 500  # a 4xx won't get better
+                if not retry:
+                    raise HttpError(f"GET {url} failed: {error!r}") from error
+
+                logging.debug("GET %s failed, retrying: %r", url, error)
+                await asyncio.sleep(self.backoff * 2**attempt)
+
+        raise HttpError(f"GET {url} failed")  # not reachable, keeps mypy happy
+
+    async def get_json(self, url: str, conditional: bool = False) -> Any:
+        """Gets a url and decodes the response as json, see `get`"""
+        body = await self.get(url, conditional)
+        return None if body is None else json.loads(body)
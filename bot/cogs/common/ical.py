@@ -0,0 +1,159 @@
+"""This module implements the CPU heavy part of handling calendar feeds.
+
+Parsing a feed, expanding its recurrences and converting the descriptions to Markdown
+takes a while for large calendars, so `expand` is meant to run in a worker process.
+It returns small, picklable occurrence records that are already normalised to the
+limits Discord puts on scheduled events.
+
+Recurring events share their description between all occurrences, so every worker
+process keeps the converted descriptions in a small LRU cache. The parsed feeds are
+kept as well, by digest, so moving the window forward only expands the new part.
+"""
+
+from __future__ import annotations
+import hashlib
+import re
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Optional
+
+import icalendar
+import recurring_ical_events  # type: ignore
+from markdownify import MarkdownConverter  # type: ignore
+
+# An occurrence of a calendar event, as handed to the event handlers
+Record = dict[str, Any]
+
+
+class ParagraphConverter(MarkdownConverter):  # pylint: disable=missing-class-docstring
+    def convert_p(self, el, text, convert_as_inline):
+        """Change parsing of p tag to have only one newline instead of 2"""
+        return super().convert_p(el, text, convert_as_inline)[:-1]
+
+
+def md(html, **options):  # pylint: disable=missing-function-docstring
+    return ParagraphConverter(**options).convert(html)
+
+
+class DescriptionCache:
+    """A bounded LRU cache of descriptions converted to Markdown
+
+    Args:
+        size: The maximum amount of descriptions kept
+    """
+
+    def __init__(self, size: int = 512) -> None:
+        self.size = size
+        self.converted: OrderedDict[bytes, str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def convert(self, html: str) -> str:
+        """Converts a description, unless it was converted before"""
+        key = hashlib.sha256(html.encode()).digest()
+        if key in self.converted:
+            self.hits += 1
+            self.converted.move_to_end(key)
+            return self.converted[key]
+
+        self.misses += 1
+        self.converted[key] = md(html)
+        if len(self.converted) > self.size:
+            self.converted.popitem(last=False)
+        return self.converted[key]
+
+    def stats(self) -> dict[str, int]:
+        """Returns the cache size and the hit/miss counters"""
+        return {
+            "cached": len(self.converted),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# One per process, shared by the feeds of all handlers
+descriptions = DescriptionCache()
+# digest -> the parsed feed, ready to expand, the least recently used first
+calendars: OrderedDict[str, Any] = OrderedDict()
+CALENDARS = 4
+# Feeds like Google's stamp every event with the moment of the download, folded or not
+DTSTAMP = re.compile(rb"^DTSTAMP[;:].*(?:\r?\n[ \t].*)*(?:\r?\n)?", re.M | re.I)
+
+
+def digest(body: bytes) -> str:
+    """Identifies the content of a feed, regardless of when it was downloaded"""
+    return hashlib.sha256(DTSTAMP.sub(b"", body)).hexdigest()
+
+
+def parse(body: bytes, key: Optional[str] = None) -> Any:
+    """Parses a feed, unless this process parsed it before"""
+    key = key or digest(body)
+    if key in calendars:
+        calendars.move_to_end(key)
+        return calendars[key]
+
+    # the recurrence attributes tell the occurrences of a rule from one-off events
+    calendars[key] = recurring_ical_events.of(
+        icalendar.Calendar.from_ical(body.decode("utf-8-sig", "replace")),
+        keep_recurrence_attributes=True,
+    )
+    if len(calendars) > CALENDARS:
+        calendars.popitem(last=False)
+    return calendars[key]
+
+
+def recurrence_id(event) -> str:
+    """The RECURRENCE-ID of an occurrence, empty for an event that doesn't recur
+
+    Occurrences generated from a rule have none, their start is the one of the rule.
+    """
+    if "RECURRENCE-ID" in event:
+        return event["RECURRENCE-ID"].dt.isoformat()
+    if "RRULE" in event or "RDATE" in event:
+        return event["DTSTART"].dt.isoformat()
+    return ""
+
+
+def record(event) -> Record:
+    """Normalises an expanded occurrence to a record"""
+    start = event["DTSTART"].dt
+    # NOTE: does not support dates, only events with set start and end times.
+    occurrence = {
+        "uid": str(event.get("UID", event["SUMMARY"])),
+        "recurrence_id": recurrence_id(event),
+        "sequence": str(event.get("SEQUENCE", "")),
+        "last_modified": str(event.get("LAST-MODIFIED", "")),
+        "name": str(event["SUMMARY"]),
+        "start_time": start,
+        "end_time": event["DTEND"].dt if "DTEND" in event else start,
+        "location": str(event.get("LOCATION", "")),
+        "description": descriptions.convert(str(event.get("DESCRIPTION", ""))),
+    }
+
+    if len(occurrence["description"]) > 999:
+        # event descriptions are max 1000 characters, API call will fail if passed
+        # messages have limit of 2000, no need for separate check there
+        occurrence["description"] = occurrence["description"][:995] + "..."
+    if len(occurrence["name"]) > 100:
+        # event name are max 100 characters, API call will fail if passed
+        occurrence["name"] = occurrence["name"][:95] + "..."
+
+    return occurrence
+
+
+def expand(
+    body: bytes, start: datetime, end: datetime, key: Optional[str] = None
+) -> tuple[list[Record], dict[str, int]]:
+    """Returns the records of the occurrences of a feed between two moments
+
+    Args:
+        body: The iCalendar feed
+        start: The moment from which occurrences are included
+        end: The moment until which occurrences are included
+        key: The digest of the feed, if already known
+
+    Returns:
+        The records, and the description cache stats of the process that made them
+    """
+    records = [record(event) for event in parse(body, key).between(start, end)]
+    return records, descriptions.stats()
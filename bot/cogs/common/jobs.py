@@ -0,0 +1,227 @@
+"""This module implements the durable queue of visit jobs shared by the bot and workers.
+
+The queue is a SQLite database in the `shared/` volume. The browser cog enqueues jobs
+and follows their status, browser workers (see `bot/worker.py`) claim and run them.
+Workers can run in other processes or containers, as long as they share the volume.
+"""
+
+from __future__ import annotations
+import json
+import sqlite3
+import time
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalise_url(url: str) -> str:
+    """Normalises the parts of a url that don't change what is visited
+
+    The scheme and host are lowercased, and a default port or empty path are dropped.
+    The query and fragment are kept as is, as payloads tend to live there.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    try:
+        port = parts.port
+    except ValueError:
+        return url  # an invalid port, leave the url for the browser to deal with
+
+    netloc = host if port in (None, DEFAULT_PORTS.get(scheme)) else f"{host}:{port}"
+    if parts.username or parts.password:
+        netloc = parts.netloc.rsplit("@", 1)[0] + "@" + netloc
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, parts.fragment))
+
+
+class Job:  # pylint: disable=too-few-public-methods
+    """A single visit, as stored in the queue"""
+
+    def __init__(self, row: sqlite3.Row) -> None:
+        self.id = row["id"]  # pylint: disable=invalid-name
+        self.challenge = row["challenge"]
+        self.url = row["url"]
+        self.status = row["status"]
+        self.attempts = row["attempts"]
+
+
+class JobQueue:
+    """A visit job queue stored in SQLite, safe to use from several processes
+
+    Args:
+        path: The path of the database file
+        max_attempts: How many times a job is tried before it is marked as failed
+    """
+
+    def __init__(self, path: str, max_attempts: int = 2) -> None:
+        self.path = path
+        self.max_attempts = max_attempts
+
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            # the bot and workers tend to start together, so the schema is locked
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS visits "
+                + "(id INTEGER PRIMARY KEY AUTOINCREMENT, challenge TEXT, url TEXT, "
+                + "key TEXT, status TEXT, attempts INTEGER DEFAULT 0, worker TEXT, "
+                + "created REAL, heartbeat REAL, finished REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS visits_status ON visits (status, id)"
+            )
+            if "key" not in [
+                c["name"] for c in conn.execute("PRAGMA table_info(visits)")
+            ]:
+                # queues made before jobs were matched by their normalised url
+                conn.execute("ALTER TABLE visits ADD COLUMN key TEXT")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS visits_key ON visits (challenge, key, id)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS workers "
+                + "(worker TEXT PRIMARY KEY, heartbeat REAL, stats TEXT)"
+            )
+            conn.execute("COMMIT")
+
+    def connect(self) -> sqlite3.Connection:
+        """Opens a connection that commits itself, use `BEGIN IMMEDIATE` to lock"""
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def enqueue(self, challenge: str, url: str, window: float = 0) -> tuple[int, bool]:
+        """Adds a job to the end of the queue, unless the same url is already queued
+
+        A job for the same challenge and normalised url that is queued, running, or
+        finished successfully in the last `window` seconds is reused instead.
+
+        Returns:
+            The id of the job, and whether it is an existing job
+        """
+        key = normalise_url(url)
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id FROM visits WHERE challenge = ? AND key = ? "
+                + "AND (status IN (?, ?) OR (status = ? AND finished > ?)) "
+                + "ORDER BY id DESC LIMIT 1",
+                (challenge, key, QUEUED, RUNNING, DONE, time.time() - window),
+            ).fetchone()
+            if row:
+                conn.execute("COMMIT")
+                return row["id"], True
+
+            job_id = conn.execute(
+                "INSERT INTO visits (challenge, url, key, status, created) "
+                + "VALUES (?, ?, ?, ?, ?)",
+                (challenge, url, key, QUEUED, time.time()),
+            ).lastrowid
+            conn.execute("COMMIT")
+        assert job_id is not None  # set by every INSERT
+        return job_id, False
+
+    def claim(self, worker: str) -> Optional[Job]:
+        """Takes the oldest queued job for the worker, if there is one"""
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM visits WHERE status = ? ORDER BY id LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE visits SET status = ?, worker = ?, heartbeat = ?, "
+                    + "attempts = attempts + 1 WHERE id = ?",
+                    (RUNNING, worker, time.time(), row["id"]),
+                )
+            conn.execute("COMMIT")
+        return Job(row) if row else None
+
+    def finish(self, job_id: int, success: bool) -> None:
+        """Marks a running job as done or failed"""
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE visits SET status = ?, finished = ? WHERE id = ?",
+                (DONE if success else FAILED, time.time(), job_id),
+            )
+
+    def status(self, job_id: int) -> tuple[str, int]:
+        """Returns the status of a job, and its position in the queue if it is queued"""
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT status FROM visits WHERE id = ?", (job_id,)
+            ).fetchone()
+            if not row:
+                return FAILED, 0
+            if row["status"] != QUEUED:
+                return row["status"], 0
+            return (
+                QUEUED,
+                conn.execute(
+                    "SELECT COUNT(*) FROM visits WHERE status = ? AND id <= ?",
+                    (QUEUED, job_id),
+                ).fetchone()[0],
+            )
+
+    def queued(self) -> int:
+        """Returns how many jobs are waiting for a worker"""
+        with self.connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM visits WHERE status = ?", (QUEUED,)
+            ).fetchone()[0]
+
+    def report(self, worker: str, running: list[int], stats: dict) -> None:
+        """Records that a worker is alive, along with its running jobs and statistics"""
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO workers (worker, heartbeat, stats) VALUES (?, ?, ?)",
+                (worker, now, json.dumps(stats)),
+            )
+            conn.executemany(
+                "UPDATE visits SET heartbeat = ? WHERE id = ?",
+                [(now, job_id) for job_id in running],
+            )
+
+    def workers(self, timeout: float) -> dict[str, dict]:
+        """Returns the statistics of every worker that reported in the last `timeout` seconds"""
+        with self.connect() as conn:
+            return {
+                row["worker"]: json.loads(row["stats"])
+                for row in conn.execute(
+                    "SELECT * FROM workers WHERE heartbeat > ?",
+                    (time.time() - timeout,),
+                )
+            }
+
+    def recover(self, timeout: float) -> None:
+        """Requeues the running jobs of workers that stopped reporting, such as after a crash
+
+        Jobs that already used all their attempts are marked as failed instead.
+        """
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE visits SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, "
+                + "finished = ? WHERE status = ? AND heartbeat < ?",
+                (
+                    self.max_attempts,
+                    QUEUED,
+                    FAILED,
+                    time.time(),
+                    RUNNING,
+                    time.time() - timeout,
+                ),
+            )
+            conn.execute(
+                "DELETE FROM visits WHERE status IN (?, ?) AND finished < ?",
+                (DONE, FAILED, time.time() - 24 * 60 * 60),
+            )
+            conn.execute("COMMIT")
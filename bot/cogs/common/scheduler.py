@@ -0,0 +1,226 @@
+"""This module implements the scheduler all Discord writes of the handlers go through.
+
+Writes are submitted with a route, such as `messages:<channel id>`, resembling the
+rate limit buckets of the Discord API. Only one write per route runs at a time, and a
+route is paced by a minimum interval between its writes. Of the writes that may run,
+the one with the highest priority goes first, so user visible work isn't stuck behind
+bulk updates. A write submitted with the key of a write that is still queued replaces
+it, so repeated edits of the same object only reach Discord once. A write that
+discord.py would have to hold back longer than the `max_ratelimit_timeout` of the bot is
+queued again for when its bucket resets, instead of blocking the route until then.
+"""
+
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any, Optional
+
+import discord
+
+# Priorities, lower goes first
+USER = 0
+NORMAL = 1
+BACKGROUND = 2
+
+
+class Write:  # pylint: disable=too-few-public-methods
+    """A write waiting in the scheduler"""
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        operation: Callable[[], Awaitable[Any]],
+        route: str,
+        priority: int,
+        key: Optional[Hashable],
+        future: asyncio.Future,
+        order: int,
+    ) -> None:
+        self.operation = operation
+        self.route = route
+        self.priority = priority
+        self.key = key
+        self.future = future
+        self.order = order
+        self.submitted = time.monotonic()
+
+
+class WriteScheduler:  # pylint: disable=too-many-instance-attributes
+    """Runs Discord writes by priority, paced per route
+
+    Args:
+        interval: The default amount of seconds between two writes of a route
+        intervals: The interval of specific routes, by the part before the `:`
+    """
+
+    def __init__(
+        self, interval: float = 0.5, intervals: Optional[dict[str, float]] = None
+    ) -> None:
+        self.interval = interval
+        self.intervals = intervals or {}
+
+        self.queue: list[Write] = []
+        self.keys: dict[Hashable, Write] = {}
+        self.busy: set[str] = set()
+        self.free: dict[str, float] = {}  # route -> when it may be written again
+        self.tasks: set[asyncio.Task] = set()
+        self.wake: Optional[asyncio.Event] = None
+        self.runner: Optional[asyncio.Task] = None
+        self.order = 0
+
+        self.done = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.latencies: deque[float] = deque(maxlen=100)
+
+    def start(self) -> None:
+        """Starts running writes, this needs to be done from within the event loop"""
+        if not self.runner:
+            # made here, as before python 3.10 an event is bound to the current loop
+            self.wake = asyncio.Event()
+            self.runner = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stops running writes, the queued writes are cancelled"""
+        if self.runner:
+            self.runner.cancel()
+            self.runner = None
+        for write in self.queue:
+            write.future.cancel()
+        self.queue.clear()
+        self.keys.clear()
+
+    def submit(
+        self,
+        operation: Callable[[], Awaitable[Any]],
+        route: str,
+        priority: int = NORMAL,
+        key: Optional[Hashable] = None,
+    ) -> asyncio.Future:
+        """Queues a write
+
+        Args:
+            operation: Makes the coroutine that does the write
+            route: The rate limit bucket of the write
+            priority: USER, NORMAL or BACKGROUND
+            key: Identifies the written object, a queued write with the same key is
+                replaced, and both submitters get the result of this one
+
+        Returns:
+            A future with the result of the write
+        """
+        if key is not None and (queued := self.keys.get(key)):
+            queued.operation = operation
+            queued.priority = min(queued.priority, priority)
+            self.coalesced += 1
+            return queued.future
+
+        self.order += 1
+        write = Write(
+            operation,
+            route,
+            priority,
+            key,
+            asyncio.get_running_loop().create_future(),
+            self.order,
+        )
+        self.queue.append(write)
+        if key is not None:
+            self.keys[key] = write
+        if self.wake:
+            self.wake.set()
+        return write.future
+
+    def next(self) -> tuple[Optional[Write], Optional[float]]:
+        """Takes the write to run next
+
+        Returns:
+            The write, or None and how long until one of the routes is free again
+        """
+        now = time.monotonic()
+        ready = [
+            w
+            for w in self.queue
+            if w.route not in self.busy and self.free.get(w.route, 0) <= now
+        ]
+        if not ready:
+            waiting = [
+                self.free[w.route] - now
+                for w in self.queue
+                if w.route not in self.busy and w.route in self.free
+            ]
+            return None, min(waiting) if waiting else None
+
+        write = min(ready, key=lambda w: (w.priority, w.order))
+        self.queue.remove(write)
+        if write.key is not None:
+            del self.keys[write.key]
+        return write, None
+
+    async def run(self) -> None:
+        """Starts the writes as their routes become free"""
+        assert self.wake
+        while True:
+            self.wake.clear()
+            write, delay = self.next()
+            if not write:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if write.future.cancelled():
+                continue
+            self.busy.add(write.route)
+            task = asyncio.create_task(self.execute(write))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def execute(self, write: Write) -> None:
+        """Runs a write and sets its result"""
+        self.latencies.append(time.monotonic() - write.submitted)
+        interval = self.intervals.get(write.route.split(":")[0], self.interval)
+        try:
+            result = await write.operation()
+        except discord.RateLimited as error:
+            # discord.py gave up waiting, so try again once the bucket reset
+            logging.warning(
+                "Rate limited on %s for %.1fs", write.route, error.retry_after
+            )
+            interval = max(interval, error.retry_after)
+            self.queue.append(write)
+            if write.key is not None:
+                self.keys.setdefault(write.key, write)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            self.failed += 1
+            if not write.future.done():
+                write.future.set_exception(error)
+        else:
+            self.done += 1
+            if not write.future.done():
+                write.future.set_result(result)
+        finally:
+            self.busy.discard(write.route)
+            self.free[write.route] = time.monotonic() + interval
+            if self.wake:
+                self.wake.set()
+
+    def stats(self) -> dict[str, Any]:
+        """Returns the queue depth per priority, the counters and the latencies"""
+        return {
+            "queued": len(self.queue),
+            "user": sum(w.priority == USER for w in self.queue),
+            "normal": sum(w.priority == NORMAL for w in self.queue),
+            "background": sum(w.priority == BACKGROUND for w in self.queue),
+            "running": len(self.busy),
+            "done": self.done,
+            "failed": self.failed,
+            "coalesced": self.coalesced,
+            "latency": (
+                sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+            ),
+            "max_latency": max(self.latencies, default=0.0),
+        }
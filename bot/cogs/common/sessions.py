@@ -0,0 +1,165 @@
+"""This module implements a cache of the browser state the challenge setups produce.
+
+Setting up a challenge means logging in or loading a page that stores the flag, which
+costs one or more full page loads. Instead, the setup runs once, the resulting cookies
+and storage are captured, and they are injected into every following browser. When
+injecting fails, or the check of the challenge finds the state is no longer valid on
+the server, the setup runs again. As a check costs a page load of its own, a session
+the server accepted recently isn't checked again.
+"""
+
+from __future__ import annotations
+import logging
+import threading
+import time
+from collections.abc import Callable
+from typing import Optional
+from urllib.parse import urlsplit
+
+from selenium import webdriver  # type: ignore
+from selenium.common.exceptions import WebDriverException  # type: ignore
+
+# Cookies can only be set for the origin of the loaded document, so a small page on the
+# origin is loaded before injecting. Whether it exists doesn't matter.
+INJECT_PATH = "/robots.txt"
+COOKIE_KEYS = (
+    "name",
+    "value",
+    "path",
+    "domain",
+    "secure",
+    "httpOnly",
+    "expiry",
+    "sameSite",
+)
+
+
+class Session:  # pylint: disable=too-few-public-methods
+    """The captured state of a browser after a challenge setup"""
+
+    def __init__(
+        self,
+        origin: str,
+        cookies: list[dict],
+        local_storage: dict[str, str],
+        session_storage: dict[str, str],
+        expires: float,
+    ) -> None:
+        self.origin = origin
+        self.cookies = cookies
+        self.local_storage = local_storage
+        self.session_storage = session_storage
+        self.expires = expires
+        self.checked = time.time()  # when the server last accepted the session
+
+
+class SessionCache:
+    """Runs the challenge setups once and replays their state into other browsers
+
+    Args:
+        setups: The setup function of every challenge, by challenge name
+        checks: The check of the challenges whose state can expire, by challenge name
+        ttl: After how many seconds a session is set up again, at the latest
+        check_interval: For how many seconds the server isn't asked about a session again
+    """
+
+    def __init__(
+        self,
+        setups: dict[str, Callable[[webdriver.Firefox], None]],
+        checks: Optional[dict[str, Callable[[webdriver.Firefox], bool]]] = None,
+        ttl: int = 1800,
+        check_interval: int = 60,
+    ) -> None:
+        self.setups = setups
+        self.checks = checks or {}
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.sessions: dict[str, Session] = {}
+        self.locks = {name: threading.Lock() for name in setups}
+
+    def apply(self, challenge: str, driver: webdriver.Firefox) -> None:
+        """Puts the browser in the state the setup of the challenge would
+
+        The setup only runs when there is no valid cached session for the challenge.
+        """
+        with self.locks[challenge]:
+            session = self.sessions.get(challenge)
+            if session and session.expires > time.time():
+                try:
+                    self.inject(driver, session)
+                    if self.valid(challenge, driver, session):
+                        return
+                    logging.info("Session of %s is no longer valid", challenge)
+                except WebDriverException:
+                    logging.exception("Failed to inject the session of %s", challenge)
+                self.sessions.pop(challenge, None)
+
+            self.sessions[challenge] = self.capture(challenge, driver)
+
+    def invalidate(self, challenge: Optional[str] = None) -> None:
+        """Drops the cached session of a challenge, or of all challenges"""
+        if challenge:
+            self.sessions.pop(challenge, None)
+        else:
+            self.sessions.clear()
+
+    def capture(self, challenge: str, driver: webdriver.Firefox) -> Session:
+        """Runs the setup of the challenge and captures the state it leaves behind"""
+        driver.delete_all_cookies()
+        self.setups[challenge](driver)
+
+        url = urlsplit(driver.current_url)
+        cookies = [
+            {key: cookie[key] for key in COOKIE_KEYS if key in cookie}
+            for cookie in driver.get_cookies()
+        ]
+        local_storage, session_storage = driver.execute_script(
+            "return [Object.assign({}, localStorage), Object.assign({}, sessionStorage)];"
+        )
+
+        expires = time.time() + self.ttl
+        for cookie in cookies:
+            if "expiry" in cookie:
+                expires = min(expires, cookie["expiry"])
+
+        return Session(
+            f"{url.scheme}://{url.netloc}",
+            cookies,
+            local_storage,
+            session_storage,
+            expires,
+        )
+
+    @staticmethod
+    def inject(driver: webdriver.Firefox, session: Session) -> None:
+        """Loads the cookies and storage of a session into the browser"""
+        driver.get(session.origin + INJECT_PATH)
+        driver.delete_all_cookies()
+        for cookie in session.cookies:
+            driver.add_cookie(cookie)
+        driver.execute_script(
+            "localStorage.clear(); sessionStorage.clear();"
+            "for (const [k, v] of Object.entries(arguments[0])) localStorage.setItem(k, v);"
+            "for (const [k, v] of Object.entries(arguments[1])) sessionStorage.setItem(k, v);",
+            session.local_storage,
+            session.session_storage,
+        )
+
+    def valid(
+        self, challenge: str, driver: webdriver.Firefox, session: Session
+    ) -> bool:
+        """Checks that the browser accepted the session, and that the server still does
+
+        The server side is only checked for challenges that have a check, and only when
+        it didn't accept the session in the last `check_interval` seconds.
+        """
+        names = {cookie["name"] for cookie in driver.get_cookies()}
+        if not all(cookie["name"] in names for cookie in session.cookies):
+            return False
+        check = self.checks.get(challenge)
+        if not check or time.time() - session.checked < self.check_interval:
+            return True
+        if not check(driver):
+            return False
+        session.checked = time.time()
+        return True
@@ -0,0 +1,113 @@
+"""This module implements a small HTTP listener for notifications pushed to the bot.
+
+External services, such as pwncrates, POST a json body to the listener. The body is
+signed with a shared secret: the `X-Signature` header holds `sha256=` followed by the
+hex HMAC-SHA256 of the body. Requests with a missing or wrong signature are rejected.
+
+Running this module sends a signed notification, to test the listener locally:
+
+    python -m bot.cogs.common.webhook http://localhost:8080/pwncrates '{"event": "solve"}'
+"""
+
+from __future__ import annotations
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import urllib.request
+from collections.abc import Awaitable, Callable
+from typing import Optional
+
+from aiohttp import web
+
+SIGNATURE_HEADER = "X-Signature"
+
+
+def sign(secret: str, body: bytes) -> str:
+    """Returns the signature header value of a body"""
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+class WebhookServer:
+    """Listens for signed notifications and hands them to a callback
+
+    Args:
+        secret: The shared secret the notifications are signed with
+        callback: Called with the decoded json body of every valid notification
+        host: The address to listen on
+        port: The port to listen on
+        path: The path notifications are POSTed to
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        secret: str,
+        callback: Callable[[dict], Awaitable[None]],
+        host: str = "0.0.0.0",
+        port: int = 8080,
+        path: str = "/",
+    ) -> None:
+        self.secret = secret
+        self.callback = callback
+        self.host = host
+        self.port = port
+
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle)
+        self.runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        """Starts listening"""
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logging.info("Listening for notifications on %s:%d", self.host, self.port)
+
+    async def stop(self) -> None:
+        """Stops listening"""
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Checks the signature of a notification and passes it on"""
+        body = await request.read()
+        if not hmac.compare_digest(
+            request.headers.get(SIGNATURE_HEADER, ""), sign(self.secret, body)
+        ):
+            logging.warning("Rejected notification from %s", request.remote)
+            return web.Response(status=401)
+
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            return web.Response(status=400)
+
+        await self.callback(payload if isinstance(payload, dict) else {})
+        return web.Response(status=204)
+
+
+def main() -> None:
+    """Sends a signed notification, the secret is read from `WEBHOOK_SECRET`"""
+    parser = argparse.ArgumentParser(description="Send a signed notification")
+    parser.add_argument("url", help="The url of the listener")
+    parser.add_argument("body", nargs="?", default="{}", help="The json body")
+    args = parser.parse_args()
+
+    body = args.body.encode()
+    request = urllib.request.Request(
+        args.url,
+        data=body,
+        headers={
+            "Content-Type": "application/json",
+            SIGNATURE_HEADER: sign(os.environ["WEBHOOK_SECRET"], body),
+        },
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        print(response.status)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,98 +1,493 @@
 """This module defines the shared base class for calendar-based event cogs."""
 
+import asyncio
+import hashlib
+import json
+import random
 import traceback
 import logging
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time, timedelta
+from typing import Literal, Optional, Union
 
-import requests
-
-import urllib.request
-import icalendar
-import recurring_ical_events  # type: ignore
-from markdownify import MarkdownConverter  # type: ignore
-from discord import EntityType, PrivacyLevel, ScheduledEvent, User
-from discord.ext import commands, tasks
+from discord import (
+    EntityType,
+    PrivacyLevel,
+    RawReactionActionEvent,
+    RawReactionClearEmojiEvent,
+    RawReactionClearEvent,
+    ScheduledEvent,
+    User,
+)
+from discord.ext import commands
+from discord.utils import format_dt
+from discord.ext.commands import Context
 from .common.handler import Handler  # type: ignore
+from .common.http_client import HttpClient  # type: ignore  # pylint: disable=import-error
+from .common.ical import Record, digest, expand  # type: ignore  # pylint: disable=import-error
+
+
+def ends_after(event: Record, now: datetime) -> bool:
+    """Whether an occurrence is still going on or in the future"""
+    end = event["end_time"]
+    if not isinstance(end, datetime):
+        return True  # a whole day, keep it like `between` would
+    return end > (now if end.tzinfo is None else now.astimezone())
+
+
+def timestamp(moment) -> float:
+    """The unix timestamp of a datetime, or of the start of a date"""
+    if not isinstance(moment, datetime):
+        moment = datetime.combine(moment, time())
+    return moment.timestamp()
+
+
+def occurrence_key(event: Record) -> tuple[str, str]:
+    """The UID and RECURRENCE-ID of an occurrence, identifying it within the calendar
+
+    The key doesn't change when an occurrence is moved, its start is only part of the
+    fingerprint.
+    """
+    return event["uid"], event["recurrence_id"]
+
+
+def legacy_key(event: Record) -> tuple[str, str]:
+    """The key a one-off occurrence was stored under before, its UID and start"""
+    return event["uid"], event["start_time"].isoformat()
+
+
+def fingerprint(event: Record, event_data: dict, state: str) -> str:
+    """A hash of everything about an occurrence that a handler acts on"""
+    return hashlib.sha256(
+        json.dumps(
+            [
+                occurrence_key(event),
+                event["sequence"],
+                event["last_modified"],
+                {
+                    key: (value.isoformat() if isinstance(value, date) else str(value))
+                    for key, value in event_data.items()
+                },
+                state,
+            ]
+        ).encode()
+    ).hexdigest()
+
+
+class Feed:  # pylint: disable=too-few-public-methods
+    """The last downloaded calendar of a handler, and the occurrences expanded from it
+
+    The occurrences are kept by their key up to `until`, when the window moves on only
+    the part after it is expanded and added.
+    """
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.digest = digest(body)
+        self.events: dict[tuple[str, str], Record] = {}
+        self.until = datetime.min
 
 
-class ParagraphConverter(MarkdownConverter):  # pylint: disable=missing-class-docstring
-    def convert_p(self, el, text, convert_as_inline):
-        """Change parsing of p tag to have only one newline instead of 2"""
-        return super().convert_p(el, text, convert_as_inline)[:-1]
+class Schedule:  # pylint: disable=too-many-instance-attributes
+    """Updates the events of a single handler at its own interval
 
+    After a failed update the interval doubles, up to `max_backoff` minutes, and every
+    interval is jittered so the feeds don't all get requested at the same moment.
 
-def md(html, **options):  # pylint: disable=missing-function-docstring
-    return ParagraphConverter(**options).convert(html)
+    Args:
+        cog: The events cog, which does the updating
+        handler: The handler to update
+        config: The `events` section of the config
+    """
 
+    def __init__(self, cog, handler: Handler, config: dict):
+        self.cog = cog
+        self.handler = handler
+        self.interval = config["interval_minutes"][handler.event_type] * 60
+        self.max_backoff = config["max_backoff_minutes"] * 60
+        self.jitter = config["jitter"]
 
+        self.failures = 0
+        self.last_run: Optional[datetime] = None
+        self.duration: Optional[float] = None
+        self.next_run: Optional[datetime] = None
+        self.error: Optional[str] = None
+        self.trigger: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Starts updating, this needs to be done from within the event loop"""
+        self.trigger = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        """Stops updating"""
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def sync_now(self) -> None:
+        """Updates right away, or right after the update that is running"""
+        if self.trigger:
+            self.trigger.set()
+
+    async def run(self) -> None:
+        """Updates, then waits for the interval or a trigger, forever"""
+        assert self.trigger
+        await self.cog.bot.wait_until_bootstrapped()
+        try:
+            await self.handler.bootstrap(
+                self.cog.bot.get_guild(self.cog.bot.config["server_id"])
+            )
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.error(
+                "Failed to bootstrap %s events:\n%s",
+                self.handler.event_type,
+                traceback.format_exc(),
+            )
+        while True:
+            self.trigger.clear()
+            self.last_run = datetime.now().astimezone()
+            started = asyncio.get_running_loop().time()
+            try:
+                await self.cog.update(self.handler)
+                self.failures, self.error = 0, None
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                self.failures += 1
+                self.error = repr(error)
+                logging.error(
+                    "Failed to update %s events:\n%s",
+                    self.handler.event_type,
+                    traceback.format_exc(),
+                )
+            self.duration = asyncio.get_running_loop().time() - started
+
+            delay = min(
+                self.interval * 2**self.failures, max(self.interval, self.max_backoff)
+            ) * random.uniform(1 - self.jitter, 1 + self.jitter)
+            self.next_run = self.last_run + timedelta(seconds=self.duration + delay)
+            try:
+                await asyncio.wait_for(self.trigger.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+# pylint: disable-next=too-many-public-methods
 class Events(commands.Cog, name="events"):
     """A class that deals with fetching events, and calling the appropriate handler."""
 
     def __init__(self, bot):
         self.bot = bot
         self.handlers = Handler.get_handlers(self.bot)
-        self.update_events.start()  # pylint: disable=no-member
+        self.client = HttpClient(timeout=30)
+        self.feeds: dict[str, Feed] = {}
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.schedules = {
+            handler.event_type: Schedule(self, handler, self.bot.config["events"])
+            for handler in self.handlers
+        }
         self.guild = self.bot.get_guild(self.bot.config["server_id"])
 
-    @tasks.loop(minutes=5)
-    async def update_events(self):
-        """Fetches events from the calendar, does processing, and calls the appropriate handler."""
+    async def cog_load(self):
+        """Opens the connection pool and starts the processes for the calendar feeds"""
+        await self.client.start()
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.bot.config["events"]["workers"]
+        )
+        for schedule in self.schedules.values():
+            schedule.start()
+
+    async def cog_unload(self):
+        """Stops the updates, closes the connection pool and stops the processes"""
+        for schedule in self.schedules.values():
+            schedule.stop()
+        await self.client.close()
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    async def update(self, handler: Handler) -> None:
+        """Fetches the calendar of a handler, does processing, and calls the handler
+
+        Raises:
+            HttpError: If the calendar could not be fetched
+            ValueError: If the calendar could not be parsed
+        """
         self.guild = self.bot.get_guild(self.bot.config["server_id"])
         if not self.guild:
             logging.error("Guild not found, skipping update")
             return
 
-        for handler in self.handlers:
-            with urllib.request.urlopen(handler.calendar_url) as u:
-                ical_string = u.read()
-            calendar = icalendar.Calendar.from_ical(ical_string)
-            events = recurring_ical_events.of(calendar).between(
-                datetime.now(),
-                datetime.now() + timedelta(days=handler.delta_days),
-            )
+        # Only revalidate feeds we still have, a 304 is useless without the calendar
+        body = await self.client.get(
+            handler.calendar_url, conditional=handler.event_type in self.feeds
+        )
 
-            scheduled_events = await self.guild.fetch_scheduled_events()
-            for event in events:
-                await self.handle_event(handler, event, scheduled_events)
+        now = datetime.now()
+        until = now + timedelta(days=handler.delta_days)
+        feed = self.feeds.get(handler.event_type)
+        if body is not None and (not feed or feed.digest != digest(body)):
+            feed = self.feeds[handler.event_type] = Feed(body)
+        assert feed
 
-    async def handle_event(
-        self, handler: Handler, event: dict, scheduled_events: list[ScheduledEvent]
+        # A changed feed is expanded for the whole window, an unchanged one only from
+        # where it was expanded until before
+        loop = asyncio.get_running_loop()
+        records, stats = await loop.run_in_executor(
+            self.pool, expand, feed.body, max(now, feed.until), until, feed.digest
+        )
+        feed.events.update((occurrence_key(record), record) for record in records)
+        feed.until = until
+        logging.debug(
+            "Expanded %d %s events, descriptions: %d cached, %d hits, %d misses",
+            len(records),
+            handler.event_type,
+            stats["cached"],
+            stats["hits"],
+            stats["misses"],
+        )
+
+        feed.events = {
+            key: event for key, event in feed.events.items() if ends_after(event, now)
+        }
+        await self.sync(handler, list(feed.events.values()), now, until)
+
+    async def sync(
+        self, handler: Handler, events: list, now: datetime, until: datetime
     ) -> None:
-        """Does some common pre-processing before calling the handler."""
-
-        # NOTE: does not support dates, only events with set start and end times.
-        event_data = {
-            "name": event["SUMMARY"],
-            "start_time": event["DTSTART"].dt,
-            "end_time": event["DTEND"].dt,
-            "location": str(event.get("LOCATION", "")),
-            "description": md(str(event.get("DESCRIPTION", ""))),
+        """Calls the handler for the occurrences that were created, changed or removed
+
+        Every occurrence handled is stored with its fingerprint, an occurrence with
+        the same fingerprint as before and an existing Discord event is skipped.
+        Occurrences are matched to Discord events through the UID and RECURRENCE-ID
+        stored in the events table. One-off occurrences stored under their start are
+        matched through it once, and stored under their new key.
+        """
+        stored, mapping = await self.stored_occurrences(handler)
+        rekeyed = self.adopt_legacy_keys(handler, events, stored, mapping)
+        matched = await self.match_scheduled_events(events, mapping)
+
+        handled = []
+        for event in events:
+            key = occurrence_key(event)
+            # what is left in stored afterwards is no longer in the calendar
+            row = await self.sync_event(
+                handler, event, matched.get(key), stored.pop(key, ("",))[0]
+            )
+            if row:
+                handled.append(row)
+
+        removed = await self.remove_stale(
+            handler,
+            {
+                key: (matched.get(key), start_time, name)
+                for key, (_, start_time, name) in stored.items()
+            },
+            now,
+            until,
+        )
+        await self.store_sync(rekeyed, handled, removed)
+
+    async def stored_occurrences(self, handler: Handler) -> tuple[dict, dict]:
+        """Loads the occurrences stored for a handler, and the Discord events mapping
+
+        Returns:
+            The fingerprint, start and name of every occurrence of the handler, and the
+            Discord event id of every occurrence of any handler, both by key
+        """
+        stored = {
+            (uid, recurrence_id): (previous, start_time, name)
+            for uid, recurrence_id, previous, start_time, name in await self.bot.db.fetchall(
+                "SELECT uid, recurrence_id, fingerprint, start_time, name "
+                + "FROM occurrences WHERE handler = ?",
+                (handler.event_type,),
+            )
+        }
+        mapping: dict[tuple[str, str], int] = {
+            (uid, recurrence_id): event_id
+            for event_id, uid, recurrence_id in await self.bot.db.fetchall(
+                "SELECT event_id, uid, recurrence_id FROM events WHERE uid IS NOT NULL"
+            )
+        }
+        return stored, mapping
+
+    @staticmethod
+    def adopt_legacy_keys(
+        handler: Handler, events: list, stored: dict, mapping: dict
+    ) -> list[tuple[str, str, str]]:
+        """Moves one-off occurrences stored under their start to their key
+
+        Returns:
+            The handler, UID and start of every occurrence moved, to update the database
+        """
+        rekeyed = []
+        for event in events:
+            key, legacy = occurrence_key(event), legacy_key(event)
+            if not key[1] and key not in mapping and legacy in mapping:
+                mapping[key] = mapping.pop(legacy)
+                if legacy in stored:
+                    stored[key] = stored.pop(legacy)
+                rekeyed.append((handler.event_type, *legacy))
+        return rekeyed
+
+    async def match_scheduled_events(
+        self, events: list, mapping: dict
+    ) -> dict[tuple[str, str], ScheduledEvent]:
+        """Finds the Discord event of every mapped occurrence and of the new ones
+
+        Returns:
+            The Discord events that still exist, by the key of their occurrence
+        """
+        scheduled_events = {e.id: e for e in await self.guild.fetch_scheduled_events()}
+        matched = {
+            key: scheduled_events[event_id]
+            for key, event_id in mapping.items()
+            if event_id in scheduled_events
+        }
+
+        # Discord events from before the mapping existed can only be found by name
+        mapped_ids = set(mapping.values())
+        unmapped = {
+            e.name: e for e in scheduled_events.values() if e.id not in mapped_ids
+        }
+        for event in events:
+            key = occurrence_key(event)
+            if key not in mapping and event["name"].rstrip() in unmapped:
+                matched[key] = unmapped.pop(event["name"].rstrip())
+        return matched
+
+    async def sync_event(
+        self,
+        handler: Handler,
+        event: Record,
+        scheduled_event: Optional[ScheduledEvent],
+        previous: str,
+    ) -> Optional[tuple]:
+        """Calls the handler for an occurrence, unless it didn't change
+
+        Returns:
+            The row to store for the occurrence, ending with the id of its Discord
+            event, or None if the handler wasn't called or failed
+        """
+        event_data = self.event_data(event)
+        current = fingerprint(event, event_data, handler.state(event_data))
+        if scheduled_event and previous == current:
+            return None
+
+        start_time = timestamp(event_data["start_time"])
+        name = event_data["name"]
+        handled_event = await self.handle_event(handler, event_data, scheduled_event)
+        if handled_event is False:
+            return None
+        return (
+            handler.event_type,
+            *occurrence_key(event),
+            current,
+            start_time,
+            name,
+            handled_event.id if handled_event else None,
+        )
+
+    async def remove_stale(
+        self, handler: Handler, stale: dict, now: datetime, until: datetime
+    ) -> list[tuple[str, str, str]]:
+        """Calls the handler for the occurrences that are no longer in the calendar
+
+        Occurrences that ended, or moved out of the window, are only forgotten.
+
+        Returns:
+            The handler, UID and RECURRENCE-ID of every occurrence to forget
+        """
+        removed = []
+        for key, (scheduled_event, start_time, name) in stale.items():
+            removed.append((handler.event_type, *key))
+            if not now.timestamp() < start_time < until.timestamp():
+                continue
+
+            try:
+                await handler.remove_event(self.guild, scheduled_event)
+                logging.info("Removed %s event %s", handler.event_type, name)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.error(
+                    "Error removing event %s:\n%s", name, traceback.format_exc()
+                )
+        return removed
+
+    async def store_sync(self, rekeyed: list, handled: list, removed: list) -> None:
+        """Writes everything a sync changed in one transaction"""
+
+        def store(conn):
+            for event_type, uid, recurrence_id in rekeyed:
+                conn.execute(
+                    "UPDATE events SET recurrence_id = '' "
+                    + "WHERE uid = ? AND recurrence_id = ?",
+                    (uid, recurrence_id),
+                )
+                conn.execute(
+                    "UPDATE OR REPLACE occurrences SET recurrence_id = '' "
+                    + "WHERE handler = ? AND uid = ? AND recurrence_id = ?",
+                    (event_type, uid, recurrence_id),
+                )
+            conn.executemany(
+                "INSERT OR REPLACE INTO occurrences (handler, uid, recurrence_id, "
+                + "fingerprint, start_time, name) VALUES (?, ?, ?, ?, ?, ?)",
+                [row[:-1] for row in handled],
+            )
+            conn.executemany(
+                "DELETE FROM occurrences WHERE handler = ? AND uid = ? "
+                + "AND recurrence_id = ?",
+                removed,
+            )
+            for _, uid, recurrence_id, *_, event_id in handled:
+                if event_id is None:
+                    continue
+                conn.execute(
+                    "UPDATE events SET uid = NULL, recurrence_id = NULL "
+                    + "WHERE uid = ? AND recurrence_id = ? AND event_id != ?",
+                    (uid, recurrence_id, event_id),
+                )
+                conn.execute(
+                    "INSERT INTO events (event_id, uid, recurrence_id) VALUES (?, ?, ?) "
+                    + "ON CONFLICT (event_id) DO UPDATE "
+                    + "SET uid = excluded.uid, recurrence_id = excluded.recurrence_id",
+                    (event_id, uid, recurrence_id),
+                )
+
+        await self.bot.db.transaction(store)
+
+    @staticmethod
+    def event_data(event: Record) -> dict:
+        """Converts an occurrence to the arguments of a Discord scheduled event"""
+        return {
+            "name": event["name"],
+            "start_time": event["start_time"],
+            "end_time": event["end_time"],
+            "location": event["location"],
+            "description": event["description"],
             "entity_type": EntityType.external,
             "privacy_level": PrivacyLevel.guild_only,
         }
 
-        if len(event_data["description"]) > 999:
-            # event descriptions are max 1000 characters, API call will fail if passed
-            # messages have limit of 2000, no need for separate check there
-            event_data["description"] = event_data["description"][:995] + "..."
-        if len(event_data["name"]) > 100:
-            # event name are max 100 characters, API call will fail if passed
-            event_data["name"] = event_data["name"][:95] + "..."
-
-        scheduled_event = next(
-            (e for e in scheduled_events if e.name ==
-             event_data["name"].rstrip()),
-            None,
-        )
+    async def handle_event(
+        self,
+        handler: Handler,
+        event_data: dict,
+        scheduled_event: Optional[ScheduledEvent],
+    ) -> Union[Optional[ScheduledEvent], Literal[False]]:
+        """Calls the handler
 
+        Returns:
+            The Discord event the handler returned, or False if the handler failed
+        """
         try:
-            await handler.handle_event(self.guild, event_data, scheduled_event)
+            return await handler.handle_event(self.guild, event_data, scheduled_event)
         except Exception:  # pylint: disable=broad-exception-caught
             logging.error(
                 "Error in event %s:\n%s",
-                event["SUMMARY"],
+                event_data["name"],
                 traceback.format_exc(),
             )
+            return False
 
     @commands.Cog.listener()
     async def on_scheduled_event_user_add(
@@ -115,11 +510,133 @@ class Events(commands.Cog, name="events"):
         for handler in self.handlers:
             await handler.event_delete(event)
 
-    @update_events.before_loop
-    async def before_loop(self):
-        """Ensures the bot is ready before the loop starts."""
-        logging.info("running before_loop")
-        await self.bot.wait_until_ready()
+        await self.bot.db.execute("DELETE FROM events WHERE event_id = ?", (event.id,))
+        logging.info("Deleted event %s", event.name)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(
+        self, payload: RawReactionActionEvent
+    ):  # pylint: disable=missing-function-docstring
+        for handler in self.handlers:
+            await handler.reaction_change(payload, True)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(
+        self, payload: RawReactionActionEvent
+    ):  # pylint: disable=missing-function-docstring
+        for handler in self.handlers:
+            await handler.reaction_change(payload, False)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear(
+        self, payload: RawReactionClearEvent
+    ):  # pylint: disable=missing-function-docstring
+        for handler in self.handlers:
+            await handler.reaction_clear(payload)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear_emoji(
+        self, payload: RawReactionClearEmojiEvent
+    ):  # pylint: disable=missing-function-docstring
+        for handler in self.handlers:
+            await handler.reaction_clear(payload)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(
+        self, channel
+    ):  # pylint: disable=missing-function-docstring
+        for handler in self.handlers:
+            handler.channel_change(None, channel)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(
+        self, before, after
+    ):  # pylint: disable=missing-function-docstring
+        for handler in self.handlers:
+            handler.channel_change(before, after)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(
+        self, channel
+    ):  # pylint: disable=missing-function-docstring
+        for handler in self.handlers:
+            handler.channel_change(channel, None)
+
+    @commands.Cog.listener()
+    async def on_thread_create(
+        self, thread
+    ):  # pylint: disable=missing-function-docstring
+        for handler in self.handlers:
+            handler.channel_change(None, thread)
+
+    @commands.Cog.listener()
+    async def on_thread_update(
+        self, before, after
+    ):  # pylint: disable=missing-function-docstring
+        for handler in self.handlers:
+            handler.channel_change(before, after)
+
+    @commands.Cog.listener()
+    async def on_thread_delete(
+        self, thread
+    ):  # pylint: disable=missing-function-docstring
+        for handler in self.handlers:
+            handler.channel_change(thread, None)
+
+    @commands.command(
+        name="refresh",
+        description="Updates the events from the calendars right away.",
+    )
+    @commands.has_permissions(administrator=True)
+    async def refresh(self, ctx: Context, handler: Optional[str] = None) -> None:
+        """
+        Updates the events of a handler right away, or of all handlers
+
+        :param context: The command context.
+        :param handler: The handler to update, like CTF or Calendar, all if not given.
+        """
+        schedules = [
+            schedule
+            for event_type, schedule in self.schedules.items()
+            if handler is None or event_type.lower() == handler.lower()
+        ]
+        if not schedules:
+            await ctx.send(f"Unknown handler, choose from {', '.join(self.schedules)}")
+            return
+
+        for schedule in schedules:
+            schedule.sync_now()
+        await ctx.send(
+            f"Updating {', '.join(s.handler.event_type for s in schedules)} events"
+        )
+
+    @commands.command(
+        name="schedules",
+        description="Shows when the events of every handler were updated.",
+    )
+    @commands.has_permissions(administrator=True)
+    async def schedule_stats(self, ctx: Context) -> None:
+        """
+        Shows the last run, its duration and the next run of every handler
+
+        :param context: The command context.
+        """
+        msg = ""
+        for event_type, schedule in self.schedules.items():
+            msg += f"- {event_type}: every {schedule.interval / 60:g} minutes, "
+            if not schedule.last_run or not schedule.next_run:
+                msg += "not run yet\n"
+                continue
+            msg += (
+                f"last run {format_dt(schedule.last_run, 'R')} "
+                f"took {schedule.duration:.1f}s, "
+                f"next run {format_dt(schedule.next_run, 'R')}"
+            )
+            if schedule.error:
+                msg += f", {schedule.failures} failures, last: `{schedule.error}`"
+            msg += "\n"
+
+        await ctx.send(msg)
 
 
 async def setup(bot) -> None:  # pylint: disable=missing-function-docstring
@@ -4,70 +4,322 @@ To provide some extra functionaly, this cog provides the roles, scoreboard, and
 dates of the solves integration on the discord for the pwncrates site.
 """
 
-import json
+import asyncio
+import hashlib
 import logging
+import time
 import traceback
 import itertools
+import os
+from typing import Optional
 
-import requests
 import discord
-from discord import Guild, Role
+from discord import Guild, Role, app_commands
 from discord.utils import get
 from discord.ext import commands, tasks
+from discord.ext.commands import Context
+from .common.history import ScoreHistory  # type: ignore  # pylint: disable=import-error
+from .common.http_client import HttpClient, HttpError  # type: ignore  # pylint: disable=import-error
+from .common.webhook import WebhookServer  # type: ignore  # pylint: disable=import-error
 
+API_URL = "https://ctf.studsec.nl/api"
 
+
+# pylint: disable-next=too-many-instance-attributes
 class Pwncrates(commands.Cog, name="pwncrates"):
     """The class that provides the pwncrates integration"""
 
     def __init__(self, bot) -> None:
         self.bot = bot
         self.roles: list[Role] = []
+        self.client = HttpClient(timeout=10)
+
+        # user_id -> (discord_id, fetched), a discord_id of None means no linked account
+        self.discord_ids: dict[int, tuple[Optional[int], float]] = {}
+        # discord_id -> role_id, the rank roles as they were last assigned
+        self.assigned: dict[int, int] = {}
+        # the scoreboard message id and the hash of what was last posted
+        self.state: dict[str, str] = {}
+        self.scoreboard: Optional[list[dict]] = None
+        self.history = ScoreHistory(self.bot.db)
+
+        self.refreshing = asyncio.Lock()
+        self.pending = False
+        self.last_push = float("-inf")
+        self.pushes: set[asyncio.Task] = set()
+        self.webhook: Optional[WebhookServer] = None
+
         self.update_scoreboard.start()  # pylint: disable=no-member
 
-    @staticmethod
-    def get_scoreboard() -> dict:
-        """Gets the scoreboard from the studsec api in json form"""
-        return json.loads(
-            requests.get("https://ctf.studsec.nl/api/scoreboard", timeout=10).text
+    async def cog_load(self) -> None:
+        """Loads the stored state, opens the api connection pool and the listener"""
+        self.discord_ids = {
+            user_id: (discord_id, fetched)
+            for user_id, discord_id, fetched in await self.bot.db.fetchall(
+                "SELECT user_id, discord_id, fetched FROM discord_ids"
+            )
+        }
+        self.assigned = dict(
+            await self.bot.db.fetchall("SELECT discord_id, role_id FROM rank_roles")
         )
+        self.state = dict(await self.bot.db.fetchall("SELECT key, value FROM state"))
+        await self.history.load()
+        await self.client.start()
+
+        config = self.bot.config["pwncrates"]["webhook"]
+        if config["enabled"]:
+            if secret := os.getenv("WEBHOOK_SECRET"):
+                self.webhook = WebhookServer(
+                    secret, self.on_push, config["host"], config["port"], "/pwncrates"
+                )
+                await self.webhook.start()
+            else:
+                logging.error("WEBHOOK_SECRET not set, not listening for pwncrates")
+
+    async def cog_unload(self) -> None:
+        """Stops the scoreboard loop, the listener and closes the connection pool"""
+        self.update_scoreboard.cancel()  # pylint: disable=no-member
+        if self.webhook:
+            await self.webhook.stop()
+        await self.client.close()
+
+    async def on_push(self, payload: dict) -> None:
+        """Refreshes the scoreboard right away when pwncrates notifies us of a change"""
+        logging.info("Scoreboard change pushed: %s", payload.get("event", "unknown"))
+        self.last_push = time.monotonic()
+        if not self.roles:
+            return  # not set up yet, the loop will pick it up
 
-    @staticmethod
-    def get_discord_id(user_id) -> int:
-        """Gets the discord id for the specific user_id"""
-        return int(
-            json.loads(
-                requests.get(
-                    f"https://ctf.studsec.nl/api/discord_id/{user_id}", timeout=10
-                ).text
-            )["discord_id"]
+        task = asyncio.create_task(self.refresh())
+        self.pushes.add(task)
+        task.add_done_callback(self.pushes.discard)
+
+    async def refresh(self) -> None:
+        """Refreshes the scoreboard, once more if a refresh was asked for meanwhile"""
+        if self.refreshing.locked():
+            self.pending = True
+            return
+
+        async with self.refreshing:
+            self.pending = True
+            while self.pending:
+                self.pending = False
+                await self.refresh_scoreboard()
+
+    async def get_scoreboard(self) -> Optional[list[dict]]:
+        """Gets the scoreboard from the studsec api in json form
+
+        Returns:
+            The scoreboard, or None if it wasn't modified since the last request
+        """
+        return await self.client.get_json(f"{API_URL}/scoreboard", conditional=True)
+
+    async def set_state(self, key: str, value: str) -> None:
+        """Stores a value that needs to survive restarts"""
+        self.state[key] = value
+        await self.bot.db.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value)
         )
 
-    async def adjust_roles(
-        self, scoreboard: dict, channel: discord.TextChannel
-    ) -> None:
-        """Updates the rank roles, if needed"""
-        for i, user in enumerate(scoreboard[:10]):
+    async def post_scoreboard(self, channel: discord.TextChannel, content: str) -> None:
+        """Edits the scoreboard message, or sends one if there is none"""
+        if message_id := self.state.get("scoreboard_message"):
             try:
-                discord_id = self.get_discord_id(user["user_id"])
-                discord_user = await channel.guild.fetch_member(discord_id)
-            except (discord.errors.NotFound, TypeError):
-                continue
+                await channel.get_partial_message(int(message_id)).edit(content=content)
+                return
+            except discord.errors.NotFound:
+                pass  # the message was deleted, send a new one
+        elif latest_message := await get(channel.history()):
+            # posted before the message id was stored, adopt it
+            await latest_message.edit(content=content)
+            await self.set_state("scoreboard_message", str(latest_message.id))
+            return
+
+        message = await channel.send(content)
+        await self.set_state("scoreboard_message", str(message.id))
+
+    async def get_discord_id(self, user_id: int) -> Optional[int]:
+        """Gets the discord id for the specific user_id, None if they didn't link one
+
+        Lookups are cached, users without a linked account for a shorter time.
+        """
+        config = self.bot.config["pwncrates"]
+        if user_id in self.discord_ids:
+            discord_id, fetched = self.discord_ids[user_id]
+            ttl = config["discord_id_ttl" if discord_id else "negative_ttl"]
+            if fetched + ttl > time.time():
+                return discord_id
+
+        data = await self.client.get_json(f"{API_URL}/discord_id/{user_id}")
+        discord_id = int(data["discord_id"]) if data.get("discord_id") else None
+
+        self.discord_ids[user_id] = (discord_id, time.time())
+        await self.bot.db.execute(
+            "INSERT OR REPLACE INTO discord_ids (user_id, discord_id, fetched) "
+            + "VALUES (?, ?, ?)",
+            (user_id, discord_id, time.time()),
+        )
+        return discord_id
+
+    @app_commands.command(
+        name="rank", description="Shows a position on the pwncrates scoreboard"
+    )
+    @app_commands.describe(username="The pwncrates username, yours if not given")
+    async def rank(
+        self, interaction: discord.Interaction, username: Optional[str] = None
+    ) -> None:
+        """Shows the position and score of a user, and how they moved this week
+
+        Args:
+            interaction: The interaction context provided
+            username: The pwncrates username to look up, the linked account if None
+        """
+        user = (
+            await self.history.find_user(username)
+            if username
+            else await self.history.find_discord_user(interaction.user.id)
+        )
+        if not user:
+            await interaction.response.send_message(
+                (
+                    f"Couldn't find {username} on the scoreboard"
+                    if username
+                    else "Couldn't find your pwncrates account, try `/rank username`"
+                ),
+                ephemeral=True,
+            )
+            return
+
+        user_id, name = user
+        now = await self.history.lookup(user_id, time.time())
+        then = await self.history.lookup(user_id, time.time() - 7 * 24 * 60 * 60)
+        assert now and then  # a known user has at least one entry
 
-            if not discord_user:
+        positions = then[0] - now[0]
+        await interaction.response.send_message(
+            f"**{name}** is #{now[0]} with {now[1]} points. This week: "
+            f"{now[1] - then[1]:+} points, "
+            + (
+                f"{'up' if positions > 0 else 'down'} {abs(positions)} places"
+                if positions
+                else "same place"
+            ),
+            ephemeral=True,
+        )
+
+    @commands.command(
+        name="forget",
+        description="Clears the cached discord ids of pwncrates users.",
+    )
+    @commands.has_permissions(administrator=True)
+    async def forget(self, ctx: Context, user_id: Optional[int] = None) -> None:
+        """
+        Clears the cached discord id of a pwncrates user, or of all users
+
+        :param context: The command context.
+        :param user_id: The pwncrates user id, all users if not given.
+        """
+        if user_id is None:
+            self.discord_ids.clear()
+            await self.bot.db.execute("DELETE FROM discord_ids")
+        else:
+            self.discord_ids.pop(user_id, None)
+            await self.bot.db.execute(
+                "DELETE FROM discord_ids WHERE user_id = ?", (user_id,)
+            )
+
+        await ctx.send("Cleared cached discord ids")
+
+    async def adjust_roles(self, scoreboard: list[dict], guild: Guild) -> None:
+        """Updates the rank roles, if the ranking changed since the last assignment
+
+        Only the members whose rank role changed are touched, they get their new rank
+        role and lose any other. Members are taken from the cache, not fetched.
+        """
+        discord_ids = await asyncio.gather(
+            *(self.get_discord_id(user["user_id"]) for user in scoreboard[:10]),
+            return_exceptions=True,
+        )
+
+        assigned: dict[int, int] = {}
+        for i, discord_id in enumerate(discord_ids):
+            if isinstance(discord_id, HttpError):
+                return  # don't take roles away because of a failed request
+            if isinstance(discord_id, BaseException):
+                raise discord_id
+            if discord_id is not None:  # None means the user has no linked discord
+                assigned.setdefault(discord_id, self.roles[i].id)
+
+        if assigned == self.assigned:
+            return
+
+        # Only the roles that were actually applied are recorded, members that
+        # weren't found are tried again the next time
+        applied = dict(self.assigned)
+        rank_roles = {role.id for role in self.roles}
+        for discord_id in assigned.keys() | self.assigned.keys():
+            if assigned.get(discord_id) == self.assigned.get(discord_id):
+                continue
+            applied.pop(discord_id, None)
+            member = guild.get_member(discord_id)
+            if not member:
                 continue  # User might not be in the discord server
 
-            if self.roles[i] not in discord_user.roles:
-                await discord_user.add_roles(self.roles[i])
+            remove = [
+                role
+                for role in member.roles
+                if role.id in rank_roles and role.id != assigned.get(discord_id)
+            ]
+            if remove:
+                await member.remove_roles(*remove)
+
+            role = guild.get_role(assigned.get(discord_id, 0))
+            if not role:
+                continue
+            if role not in member.roles:
+                await member.add_roles(role)
+            applied[discord_id] = role.id
+
+        # A missing member leaves the assignment as it was, which needn't be stored
+        if applied == self.assigned:
+            return
+        self.assigned = applied
+
+        def store(conn):
+            conn.execute("DELETE FROM rank_roles")
+            conn.executemany(
+                "INSERT INTO rank_roles (discord_id, role_id) VALUES (?, ?)",
+                applied.items(),
+            )
+
+        await self.bot.db.transaction(store)
 
     @tasks.loop(seconds=30)
     async def update_scoreboard(self) -> None:
-        """A loop to update the scoreboard on discord and (re)assign rank roles, if needed"""
+        """A loop to refresh the scoreboard, which slows down while changes are pushed"""
+        config = self.bot.config["pwncrates"]
+        pushed = time.monotonic() - self.last_push < config["push_timeout"]
+        self.update_scoreboard.change_interval(  # pylint: disable=no-member
+            seconds=config["push_interval" if pushed else "interval"]
+        )
+
+        await self.refresh()
+
+    async def refresh_scoreboard(self) -> None:
+        """Updates the scoreboard on discord and (re)assigns rank roles, if needed"""
 
         try:
-            scoreboard = self.get_scoreboard()
-        except requests.exceptions.RequestException:
+            fetched = await self.get_scoreboard()
+        except HttpError:
             return  # something failed with the request, return and let the next loop try again
 
+        if fetched:
+            await self.history.record(fetched)
+        scoreboard = fetched or self.scoreboard
+        if not scoreboard:
+            return
+        self.scoreboard = scoreboard
+
         new_scoreboard = "```\n"
         # API already orders users by score, we can take top 25
         for user in scoreboard[:25]:
@@ -79,13 +331,14 @@ class Pwncrates(commands.Cog, name="pwncrates"):
         if not isinstance(scoreboard_channel, discord.TextChannel):
             return
 
+        # Only the post depends on the rendered scoreboard, the roles are checked
+        # every time as members that weren't found before may have shown up since
+        digest = hashlib.sha256(new_scoreboard.encode()).hexdigest()
         try:
-            latest_message = await get(scoreboard_channel.history())
-            if latest_message and new_scoreboard != latest_message.content:
-                await latest_message.edit(content=new_scoreboard)
-            elif not latest_message:
-                await scoreboard_channel.send(new_scoreboard)
-            await self.adjust_roles(scoreboard, scoreboard_channel)
+            if digest != self.state.get("scoreboard_hash"):
+                await self.post_scoreboard(scoreboard_channel, new_scoreboard)
+                await self.set_state("scoreboard_hash", digest)
+            await self.adjust_roles(scoreboard, guild)
         except ConnectionRefusedError:
             return
         except discord.errors.Forbidden:
@@ -105,12 +358,19 @@ class Pwncrates(commands.Cog, name="pwncrates"):
                 role = await guild.create_role(name=name)
             self.roles += [role] * i
 
+        if not self.assigned:
+            # Nothing assigned yet, start from whoever holds a rank role right now
+            self.assigned = {
+                member.id: role.id for role in self.roles for member in role.members
+            }
+
     @update_scoreboard.before_loop
     async def before_loop(self) -> None:
-        """Make sure the bot is ready, clean scoreboard channel, and get/make needed roles"""
-        guild: Guild = self.bot.get_guild(self.bot.config["server_id"])
+        """Make sure the bot is set up, and get/make needed roles"""
+        await self.bot.wait_until_bootstrapped()
 
-        await self.bot.wait_until_ready()
+        # only in the cache once the bot is ready
+        guild: Guild = self.bot.get_guild(self.bot.config["server_id"])
         await self.setup_roles(guild)
 
 
@@ -4,11 +4,12 @@ In this file, the `StudBot` is defined, initialized, and extended with the cogs.
 Run this file using `poetry` as described in the `README.md`
 """
 
+import asyncio
 import os
 import logging
 import json
-import sqlite3
 import sys
+from typing import Any
 
 import discord
 from discord import app_commands, PermissionOverwrite, Interaction
@@ -17,8 +18,11 @@ from discord.ext.commands import Context
 from dotenv import load_dotenv
 from termcolor import colored
 
+from .cogs.common.database import Database  # type: ignore
+from .cogs.common.scheduler import WriteScheduler  # type: ignore
 
-class StudBot(commands.Bot):
+
+class StudBot(commands.Bot):  # pylint: disable=too-many-instance-attributes
     """This is the entrypoint when running the bot, with all the initialization and friends"""
 
     def __init__(self) -> None:
@@ -28,11 +32,17 @@ class StudBot(commands.Bot):
         - The intents and sets the prefix for `super`;
         """
         self.channels: dict[str, int] = {}
+        self.bootstrapping = False
         self.path = f"{os.path.realpath(os.path.dirname(__file__))}"
         self.shared = os.path.abspath(f"{self.path}/..") + "/shared"
 
         with open(f"{self.path}/config.json", "r", encoding="utf-8") as file:
             self.config = json.load(file)
+        self.db = Database(f"{self.shared}/events.db")
+        self.writes = WriteScheduler(
+            self.config["writes"]["interval"], self.config["writes"]["routes"]
+        )
+
         if server_id := os.getenv("SERVER_ID"):
             self.config["server_id"] = int(server_id)
         else:
@@ -45,8 +55,13 @@ class StudBot(commands.Bot):
         intents.guild_messages = True
         intents.guild_scheduled_events = True
 
-        # prefix only used for sync command
-        super().__init__(intents=intents, command_prefix="!")
+        # prefix only used for sync command. Writes that would wait longer than the
+        # timeout raise instead, so the scheduler can run other routes meanwhile
+        super().__init__(
+            intents=intents,
+            command_prefix="!",
+            max_ratelimit_timeout=self.config["writes"]["max_ratelimit_timeout"],
+        )
 
     async def setup_channels(self) -> None:
         """Gets or sets up the channels, possible restricted, and sets the channels class member"""
@@ -58,63 +73,101 @@ class StudBot(commands.Bot):
         public = self.config["public"]
         private = self.config["private"]
 
-        for name in public["channels"] + private["channels"]:
-            channel = next((c for c in guild.channels if c.name == name), None)
-            if not channel:
-                logging.info("Creating channel %s", name)
-                args = {"name": name}
-
-                if name in private["channels"]:
-                    args["overwrites"] = {
-                        guild.default_role: PermissionOverwrite(view_channel=False),
-                        **{
-                            role: PermissionOverwrite(view_channel=True)
-                            for role in guild.roles
-                            if role.name in private["roles"]
-                        },
-                    }
-
-                channel = (
-                    await guild.create_voice_channel(**args)
-                    if "voice" in name
-                    else await guild.create_text_channel(**args)
-                )
-
-            self.channels[name] = channel.id
-            logging.info("Gathered channel %s", name)
-
-    async def create_db(self) -> None:
-        """Creates the database for the events cog"""
-        with sqlite3.connect(f"{self.shared}/events.db") as conn:
-            conn.execute(
-                "CREATE TABLE IF NOT EXISTS events "
-                + "(event_id INTEGER PRIMARY KEY, message_id INTEGER, is_preview INTEGER)"
+        async def create(name: str):
+            logging.info("Creating channel %s", name)
+            args: dict[str, Any] = {"name": name}
+
+            if name in private["channels"]:
+                args["overwrites"] = {
+                    guild.default_role: PermissionOverwrite(view_channel=False),
+                    **{
+                        role: PermissionOverwrite(view_channel=True)
+                        for role in guild.roles
+                        if role.name in private["roles"]
+                    },
+                }
+
+            return (
+                await guild.create_voice_channel(**args)
+                if "voice" in name
+                else await guild.create_text_channel(**args)
             )
 
+        # the first channel of a name wins, like a search through the list would
+        channels = {}
+        for channel in reversed(guild.channels):
+            channels[channel.name] = channel
+
+        names = public["channels"] + private["channels"]
+        missing = [name for name in names if name not in channels]
+        channels.update(zip(missing, await asyncio.gather(*map(create, missing))))
+
+        for name in names:
+            self.channels[name] = channels[name].id
+            logging.info("Gathered channel %s", name)
+
     async def load_cogs(self) -> None:
-        """Loads in all the cogs defined in the `bot/cogs` directory"""
-        for file in os.listdir(f"{self.path}/cogs"):
-            if file.endswith(".py") and not file == "ctf.py":
-                logging.info("Loading cog: %s", colored(file, "blue"))
-                await self.load_extension(f"bot.cogs.{file[:-3]}")
+        """Loads in all the cogs defined in the `bot/cogs` directory, concurrently"""
+        files = [
+            file
+            for file in sorted(os.listdir(f"{self.path}/cogs"))
+            if file.endswith(".py") and not file == "ctf.py"
+        ]
+        for file in files:
+            logging.info("Loading cog: %s", colored(file, "blue"))
+        await asyncio.gather(
+            *(self.load_extension(f"bot.cogs.{file[:-3]}") for file in files)
+        )
+
+    async def setup_hook(self) -> None:
+        """
+        Runs once, before connecting to Discord
+        starts the database and the write scheduler, and loads the cogs
+        """
+        # made here, as before python 3.10 an event is bound to the current loop
+        # pylint: disable-next=attribute-defined-outside-init
+        self.bootstrapped = asyncio.Event()
+        self.writes.start()
+        await self.db.start()
+        await self.load_cogs()
+
+    async def wait_until_bootstrapped(self) -> None:
+        """Waits until the bot is ready and the channels are set up
+
+        Loops of the cogs should wait for this before touching the guild.
+        """
+        await self.wait_until_ready()
+        await self.bootstrapped.wait()
 
     async def on_ready(self):
         """
-        Runs when the bot is ready and fully connected
-        entrypoint to call all the other setup functions
+        Runs when the bot is ready and fully connected, also after reconnecting
+        sets up the channels, the first time only
         """
+        if self.bootstrapped.is_set() or self.bootstrapping:
+            logging.info("Reconnected as: %s", colored(self.user.name, "blue"))
+            return
+        self.bootstrapping = True
+
         logging.info("-" * 20)
         logging.info("Logged in as: %s", colored(self.user.name, "blue"))
         logging.info("User ID is: %s", colored(self.user.id, "blue"))
         logging.info("discord.py version: %s", colored(discord.__version__, "blue"))
         logging.info("Connected to:")
-        async for server in self.fetch_guilds():
+        for server in self.guilds:
             logging.info("+ %s", colored(server, "blue"))
         logging.info("-" * 20)
 
-        await self.create_db()
-        await self.setup_channels()
-        await self.load_cogs()
+        try:
+            await self.setup_channels()
+            self.bootstrapped.set()
+        finally:
+            self.bootstrapping = False
+
+    async def close(self) -> None:
+        """Closes the connection to Discord, and then the database"""
+        await super().close()
+        await self.db.close()
 
     async def on_command_error(  # pylint: disable=arguments-differ, unused-argument
         self, context: Context, error
@@ -138,10 +191,11 @@ class StudBot(commands.Bot):
             error: The encountered error of the command
         """
         if isinstance(error, app_commands.CommandOnCooldown):
-            return await interaction.response.send_message(
+            await interaction.response.send_message(
                 f"You are on cooldown. Try again in **{round(error.retry_after)} seconds**!",
                 ephemeral=True,
             )
+            return
         raise error
 
 
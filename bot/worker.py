@@ -0,0 +1,144 @@
+"""This module is the entrypoint of the browser worker.
+
+The worker runs the Selenium part of the browser cog, so a crashing or bloated Firefox
+can't take the bot down with it. It claims visit jobs from the queue in the `shared/`
+volume, visits them with a pool of warm browsers and reports back through the queue.
+Run it using `poetry run worker`, as many times as needed, on the host of the bot: the
+queue is a SQLite database in WAL mode, which doesn't work over network filesystems.
+"""
+
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from functools import partial
+
+from .cogs.common.browser_pool import BrowserPool  # type: ignore
+from .cogs.common.challenges import CHALLENGES, CHECKS  # type: ignore
+from .cogs.common.completion import wait_for_completion  # type: ignore
+from .cogs.common.jobs import Job, JobQueue  # type: ignore
+from .cogs.common.sessions import SessionCache  # type: ignore
+
+HEARTBEAT = 5  # seconds between reports to the queue
+STALE = 60  # seconds without a report after which a worker is considered dead
+POLL = 1  # seconds to wait when the queue is empty
+
+
+class BrowserWorker:  # pylint: disable=too-many-instance-attributes
+    """Claims visit jobs from the queue and runs them on a pool of browsers
+
+    Args:
+        config: The `browser` section of the bot configuration
+        shared: The path of the shared volume holding the queue
+    """
+
+    def __init__(self, config: dict, shared: str) -> None:
+        self.config = config
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+        self.queue = JobQueue(f"{shared}/visits.db")
+
+        self.sessions = SessionCache(
+            CHALLENGES,
+            CHECKS,
+            ttl=config["session_ttl"],
+            check_interval=config["session_check_interval"],
+        )
+        self.pool = BrowserPool(
+            {name: partial(self.sessions.apply, name) for name in CHALLENGES},
+            pool_size=config["pool_size"],
+            max_visits=config["max_visits"],
+            max_rss_mb=config["max_rss_mb"],
+        )
+
+        self.running: set[int] = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def run(self) -> None:
+        """Runs the worker threads and reports to the queue until the worker is stopped"""
+        logging.info("Starting browser worker %s", self.name)
+        self.pool.warm()
+
+        threads = [
+            threading.Thread(target=self.work, daemon=True)
+            for _ in range(self.config["concurrency"])
+        ]
+        for thread in threads:
+            thread.start()
+
+        while not self.stopping.wait(HEARTBEAT):
+            with self.lock:
+                running = list(self.running)
+            self.queue.report(self.name, running, self.pool.stats())
+            self.queue.recover(STALE)
+
+        for thread in threads:
+            thread.join()
+        self.pool.close()
+
+    def work(self) -> None:
+        """Claims and visits jobs one at a time"""
+        while not self.stopping.is_set():
+            job = self.queue.claim(self.name)
+            if not job:
+                time.sleep(POLL)
+                continue
+
+            with self.lock:
+                self.running.add(job.id)
+            try:
+                self.visit(job)
+            finally:
+                with self.lock:
+                    self.running.discard(job.id)
+
+    def visit(self, job: Job) -> None:
+        """Visits the link of a job with a browser from the pool, and reports the result
+
+        The result is reported before the browser is reset, which takes a while.
+        """
+        try:
+            browser = self.pool.acquire(job.challenge)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.exception("Failed to get a browser for %s", job.challenge)
+            self.queue.finish(job.id, False)
+            return
+
+        try:
+            try:
+                browser.driver.get(job.url)
+            except Exception:  # pylint: disable=broad-exception-caught
+                visited = False
+            else:
+                dwell = self.config["dwell"]
+                wait_for_completion(
+                    browser.driver, **dwell.get(job.challenge, dwell["default"])
+                )
+                visited = True
+            self.queue.finish(job.id, visited)
+        finally:
+            self.pool.release(browser)
+
+
+def main() -> None:
+    """The main function. Call this to start a browser worker"""
+    logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+    path = os.path.realpath(os.path.dirname(__file__))
+    with open(f"{path}/config.json", "r", encoding="utf-8") as file:
+        config = json.load(file)
+
+    worker = BrowserWorker(config["browser"], os.path.abspath(f"{path}/..") + "/shared")
+    signal.signal(signal.SIGTERM, lambda *_: worker.stopping.set())
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stopping.set()
+        worker.pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Tests matching calendar occurrences to the Discord events made for them."""
+
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+from bot.cogs.common.database import Database
+from bot.cogs.common import ical
+from bot.cogs.common.ical import expand
+from bot.cogs.events import Events
+
+FEED = """BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VEVENT
+UID:meetup@studsec
+DTSTAMP:{stamp}
+SUMMARY:Meetup
+DTSTART:{start}
+DTEND:{end}
+END:VEVENT
+BEGIN:VEVENT
+UID:weekly@studsec
+SUMMARY:Weekly
+DTSTART:20300101T150000Z
+DTEND:20300101T160000Z
+RRULE:FREQ=WEEKLY;COUNT=3
+END:VEVENT
+BEGIN:VEVENT
+UID:monthly@studsec
+SUMMARY:Monthly
+DTSTART:20300120T150000Z
+DTEND:20300120T160000Z
+RRULE:FREQ=MONTHLY;COUNT=2
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def feed(start: datetime, stamp: datetime = datetime(2029, 1, 1)) -> bytes:
+    """A feed with a one-off event at a moment, and events that recur
+
+    The stamp is when the feed was downloaded, which some feeds put on every event.
+    """
+    return FEED.format(
+        start=start.strftime("%Y%m%dT%H%M%SZ"),
+        end=(start + timedelta(hours=2)).strftime("%Y%m%dT%H%M%SZ"),
+        stamp=stamp.strftime("%Y%m%dT%H%M%SZ"),
+    ).encode()
+
+
+class FakeGuild:  # pylint: disable=too-few-public-methods
+    """The scheduled events of a guild"""
+
+    def __init__(self):
+        self.scheduled_events = {}
+
+    async def fetch_scheduled_events(
+        self,
+    ):  # pylint: disable=missing-function-docstring
+        return list(self.scheduled_events.values())
+
+
+class FakeHandler:
+    """Creates, edits and removes scheduled events of a guild, and remembers doing so"""
+
+    event_type = "Calendar"
+    calendar_url = "https://calendar.example/basic.ics"
+    delta_days = 30
+
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+        self.created, self.edited, self.removed = [], [], []
+
+    def state(self, _event_data):  # pylint: disable=missing-function-docstring
+        return ""
+
+    async def handle_event(
+        self, _guild, event_data, scheduled_event
+    ):  # pylint: disable=missing-function-docstring
+        if scheduled_event:
+            self.edited.append(event_data["name"])
+        else:
+            scheduled_event = SimpleNamespace(id=len(self.guild.scheduled_events) + 1)
+            self.guild.scheduled_events[scheduled_event.id] = scheduled_event
+            self.created.append(event_data["name"])
+        scheduled_event.name = event_data["name"]
+        scheduled_event.start_time = event_data["start_time"]
+        return scheduled_event
+
+    async def remove_event(
+        self, _guild, scheduled_event
+    ):  # pylint: disable=missing-function-docstring
+        self.removed.append(scheduled_event)
+
+
+class EventsTestCase(unittest.IsolatedAsyncioTestCase):
+    """An events cog with its database, and a handler for a fake guild"""
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.db = Database(os.path.join(self.directory.name, "events.db"))
+        await self.db.start()
+
+        self.guild = FakeGuild()
+        self.handler = FakeHandler(self.guild)
+        self.events = Events.__new__(Events)
+        self.events.bot = SimpleNamespace(db=self.db)
+        self.events.guild = self.guild
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        self.directory.cleanup()
+
+
+class TestSync(EventsTestCase):
+    """Syncs a feed, then the same feed with the one-off event moved"""
+
+    async def sync(self, start: datetime) -> None:
+        """Expands a feed with the one-off event at a moment, and syncs it"""
+        now, until = datetime(2029, 12, 1), datetime(2030, 2, 1)
+        records, _ = expand(feed(start), now, until)
+        await self.events.sync(self.handler, records, now, until)
+
+    async def test_moved_event_is_edited(self):
+        """Moving an event edits its Discord event, instead of making a new one"""
+        await self.sync(datetime(2030, 1, 2, 18))
+        self.assertEqual(self.handler.created.count("Meetup"), 1)
+        self.assertEqual(self.handler.created.count("Weekly"), 3)
+        self.assertEqual(self.handler.created.count("Monthly"), 1)
+
+        await self.sync(datetime(2030, 1, 3, 19))
+        self.assertEqual(self.handler.created.count("Meetup"), 1)
+        self.assertEqual(self.handler.edited, ["Meetup"])
+        self.assertEqual(self.handler.removed, [])
+        self.assertEqual(len(self.guild.scheduled_events), 5)
+        (meetup,) = [
+            e for e in self.guild.scheduled_events.values() if e.name == "Meetup"
+        ]
+        self.assertEqual(meetup.start_time.day, 3)
+
+    async def test_unchanged_event_is_skipped(self):
+        """Syncing the same feed again doesn't touch the Discord events"""
+        await self.sync(datetime(2030, 1, 2, 18))
+        await self.sync(datetime(2030, 1, 2, 18))
+        self.assertEqual(len(self.handler.created), 5)
+        self.assertEqual(self.handler.edited, [])
+        self.assertEqual(self.handler.removed, [])
+
+    async def test_legacy_keys_are_adopted(self):
+        """One-off events stored under their start keep their Discord event"""
+        start = datetime(2030, 1, 2, 18)
+        await self.sync(start)
+        # as stored before one-off events were keyed by their UID alone
+        legacy = start.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+        await self.db.execute(
+            "UPDATE events SET recurrence_id = ? WHERE uid = 'meetup@studsec'",
+            (legacy,),
+        )
+        await self.db.execute(
+            "UPDATE occurrences SET recurrence_id = ? WHERE uid = 'meetup@studsec'",
+            (legacy,),
+        )
+
+        await self.sync(start)
+        self.assertEqual(len(self.handler.created), 5)
+        self.assertEqual(self.handler.removed, [])
+        rows = await self.db.fetchall(
+            "SELECT recurrence_id FROM events WHERE uid = 'meetup@studsec' "
+            + "UNION ALL SELECT recurrence_id FROM occurrences "
+            + "WHERE uid = 'meetup@studsec'"
+        )
+        self.assertEqual([row[0] for row in rows], ["", ""])
+
+
+class TestUpdate(EventsTestCase):
+    """Downloads a feed twice, as regenerated by the calendar in between"""
+
+    async def test_restamped_feed_expands_the_tail(self):
+        """A feed that only differs in DTSTAMP is expanded from where it was before"""
+        start = datetime.now() + timedelta(days=2)
+        bodies = [feed(start, datetime(2030, 1, 1)), feed(start, datetime(2030, 1, 2))]
+        self.assertNotEqual(bodies[0], bodies[1])
+
+        async def get(_url, conditional=False):  # pylint: disable=unused-argument
+            return bodies.pop(0)
+
+        self.events.bot.config = {"server_id": 1}
+        self.events.bot.get_guild = lambda _id: self.guild
+        self.events.client = SimpleNamespace(get=get)
+        self.events.feeds = {}
+        self.events.pool = None
+
+        with mock.patch("bot.cogs.events.expand", wraps=ical.expand) as expanded:
+            await self.events.update(self.handler)
+            feed_until = self.events.feeds["Calendar"].until
+            await self.events.update(self.handler)
+
+        self.assertEqual(expanded.call_count, 2)
+        self.assertEqual(expanded.call_args_list[1].args[1], feed_until)
+        self.assertEqual(self.handler.created, ["Meetup"])
+        self.assertEqual(self.handler.edited, [])
+
+
+if __name__ == "__main__":
+    unittest.main()